@@ -0,0 +1,90 @@
+""" Throughput of the connected component engine on masks with many fragments.
+
+    Run from the repository root: python benchmarks/bench_components.py"""
+
+import argparse
+import os
+import sys
+import time
+
+import cc3d
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'psqc'))
+
+from psqc_tools.components import label_components  # noqa: E402
+from psqc_tools.functions import filter_small_components, patch_holes  # noqa: E402
+
+
+def fragmented_mask(shape: tuple, n_fragments: int, seed: int = 0) -> np.ndarray:
+    """Makes a mask with one large ellipsoid and n_fragments single voxel fragments around it.
+
+    Fragments sit on a stride-2 lattice, so no two of them (and none of them and the ellipsoid) touch.
+
+    Args:
+        shape (tuple): shape of the mask (z, y, x)
+        n_fragments (int): number of separate fragments
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        np.ndarray: boolean mask
+    """
+    rng = np.random.default_rng(seed)
+    zz, yy, xx = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    center = [s / 2 for s in shape]
+    radius = ((zz - center[0]) / (shape[0] / 3)) ** 2 + ((yy - center[1]) / (shape[1] / 8)) ** 2 + \
+        ((xx - center[2]) / (shape[2] / 8)) ** 2
+
+    mask = radius < 1
+
+    lattice = np.zeros(shape, dtype=bool)
+    lattice[::2, ::2, ::2] = True
+    lattice[radius < 1.5] = False
+    candidates = np.flatnonzero(lattice)
+    if n_fragments > len(candidates):
+        raise Exception(f'Cannot place {n_fragments} fragments in a mask of shape {shape}')
+
+    mask.flat[rng.choice(candidates, n_fragments, replace=False)] = True
+
+    return mask
+
+
+def timed(func, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--shape', type=int, nargs=3, default=[30, 512, 512], help='mask shape (z y x)')
+    parser.add_argument('--fragments', type=int, nargs='+', default=[10, 1000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    shape = tuple(args.shape)
+    voxels = np.prod(shape)
+    print(f'shape {shape}, best of {args.repeat}')
+    print(f'{"fragments":>10} {"label":>10} {"ranked":>10} {"filter":>10} {"patch":>10} {"Mvox/s":>8} {"largest_k(100)":>15}')
+
+    for n_fragments in args.fragments:
+        mask = fragmented_mask(shape, n_fragments)
+        components = label_components(mask)
+        if components.n != n_fragments + 1:
+            raise Exception(f'Expected {n_fragments + 1} components, found {components.n}')
+
+        t_label = timed(lambda: label_components(mask), args.repeat)
+        t_ranked = timed(lambda: components.ranked(), args.repeat)
+        t_filter = timed(lambda: filter_small_components(mask), args.repeat)
+        t_patch = timed(lambda: patch_holes(mask), args.repeat)
+        t_largest_k = timed(lambda: cc3d.largest_k(mask, k=100, connectivity=6), args.repeat)
+
+        print(f'{n_fragments:>10} {t_label:>9.3f}s {t_ranked:>9.4f}s {t_filter:>9.3f}s {t_patch:>9.3f}s '
+              f'{voxels / t_filter / 1e6:>8.1f} {t_largest_k:>14.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+""" Timing and peak memory of the QC stages and of whole qc_zone / qc_lesion runs on synthetic masks.
+
+    Run from the repository root: python benchmarks/bench_qc.py --json results.json
+    and compare two versions with: python benchmarks/bench_qc.py --compare old.json"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import cc3d
+import numpy as np
+import SimpleITK as sitk
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'psqc'))
+
+from psqc_tools.functions import filter_small_components, patch_holes, process_scan, process_zones  # noqa: E402
+from psqc_tools.scan_class import Scan, write_image  # noqa: E402
+from psqc_tools.separate_masks import separate_array  # noqa: E402
+from synthetic import write_dataset  # noqa: E402
+
+
+def _peak_rss_mb() -> float:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def measure(func, items: list, repeat: int) -> dict:
+    """Runs func on every item, repeat times.
+
+    Peak memory is that of numpy and python allocations (tracemalloc), measured in a separate run so tracing
+    does not slow down the timed ones. Memory allocated inside SimpleITK is not included.
+
+    Returns:
+        dict: best and mean seconds per item and peak MB
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        times.append((time.perf_counter() - start) / len(items))
+
+    tracemalloc.start()
+    for item in items:
+        func(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': min(times), 'mean_seconds': float(np.mean(times)), 'peak_mb': peak / 2 ** 20}
+
+
+def _run_qc(kind: str, kwargs: dict, work_dir: str) -> tuple:
+    from psqc import qc_lesion, qc_zone
+
+    os.chdir(work_dir)
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        start = time.perf_counter()
+        qc_zone(**kwargs) if kind == 'zone' else qc_lesion(**kwargs)
+        seconds = time.perf_counter() - start
+
+    return seconds, _peak_rss_mb()
+
+
+def measure_run(kind: str, kwargs: dict, patients: int, repeat: int) -> dict:
+    """Times a whole qc_zone or qc_lesion run, each in a fresh process so its peak RSS is its own.
+
+    Returns:
+        dict: best and mean seconds per patient and peak RSS in MB
+    """
+    times, peaks = [], []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as work_dir, \
+                ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            seconds, peak = executor.submit(_run_qc, kind, kwargs, work_dir).result()
+        times.append(seconds / patients)
+        peaks.append(peak)
+
+    return {'seconds': min(times), 'mean_seconds': float(np.mean(times)),
+            'peak_mb': max(peaks) if None not in peaks else None}
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'numpy': np.__version__, 'SimpleITK': sitk.Version_VersionString(),
+            'cc3d': getattr(cc3d, '__version__', ''), 'cpus': os.cpu_count()}
+
+
+def run_benchmarks(args, data_dir: str) -> list:
+    shape = tuple(args.shape)
+    dirs = write_dataset(data_dir, args.patients, shape, fragments=args.fragments, holes=args.holes,
+                         strays=args.strays)
+    files = {name: sorted(os.path.join(path, f) for f in os.listdir(path)) for name, path in dirs.items()}
+
+    combined = [sitk.ReadImage(path) for path in files['combined']]
+    lesions = [Scan(path=path).load() for path in files['lesion']]
+    zones = []
+    for image in combined:
+        whole, perif, central = separate_array(sitk.GetArrayFromImage(image))
+        zones.append((whole, Scan(array=perif, ref=image), Scan(array=central, ref=image)))
+
+    out_dir = os.path.join(data_dir, 'written')
+    os.makedirs(out_dir)
+
+    stages = {
+        'read': (lambda path: sitk.ReadImage(path), files['combined']),
+        'separate': (lambda image: separate_array(sitk.GetArrayViewFromImage(image)), combined),
+        'filter_small_components': (lambda zone: filter_small_components(zone[0]), zones),
+        'patch_holes': (lambda zone: patch_holes(zone[0]), zones),
+        'process_zones': (lambda zone: process_zones(zone[1], zone[2]), zones),
+        'process_scan_lesion': (lambda scan: process_scan(scan, to_patch_holes=True, to_filter_small_components=True),
+                                lesions),
+        'write': (lambda image: sitk.WriteImage(image, os.path.join(out_dir, 'mask.nii.gz')), combined),
+        'write_nii_gz_level_1': (lambda image: write_image(image, os.path.join(out_dir, 'mask.nii.gz'),
+                                                           compression_level=1), combined),
+        'write_nii': (lambda image: write_image(image, os.path.join(out_dir, 'mask.nii')), combined),
+        'write_mhd': (lambda image: write_image(image, os.path.join(out_dir, 'mask.mhd')), combined),
+        'write_npz': (lambda image: write_image(image, os.path.join(out_dir, 'mask.npz')), combined),
+        'write_npy': (lambda image: write_image(image, os.path.join(out_dir, 'mask.npy')), combined),
+    }
+
+    results = []
+    for name, (func, items) in stages.items():
+        results.append({'name': name, **measure(func, items, args.repeat)})
+        print_result(results[-1])
+
+    runs = {
+        'qc_zone_combined': ('zone', {'combined_path': dirs['combined']}),
+        'qc_zone_separate': ('zone', {'whole_path': dirs['whole'], 'peripheral_path': dirs['peripheral'],
+                                      'central_path': dirs['central'], 'check_whole': True}),
+        'qc_lesion': ('lesion', {'lesions_path': dirs['lesion']}),
+    }
+    for name, (kind, kwargs) in runs.items():
+        results.append({'name': name, **measure_run(kind, kwargs, args.patients, args.repeat)})
+        print_result(results[-1])
+
+    return results
+
+
+def print_result(result: dict, baseline: dict = None) -> None:
+    peak = f'{result["peak_mb"]:>9.1f}' if result['peak_mb'] is not None else f'{"-":>9}'
+    line = f'{result["name"]:<25} {result["seconds"] * 1000:>10.2f} {result["mean_seconds"] * 1000:>10.2f} {peak}'
+    if baseline is not None:
+        line += f' {result["seconds"] / baseline["seconds"]:>8.2f}x'
+    print(line)
+
+
+def baseline_commit(path: str) -> str:
+    with open(path) as f:
+        return json.load(f)['environment']['commit']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--patients', type=int, default=10)
+    parser.add_argument('--shape', type=int, nargs=3, default=[24, 384, 384], help='mask shape (z y x)')
+    parser.add_argument('--fragments', type=int, default=20)
+    parser.add_argument('--holes', type=int, default=5)
+    parser.add_argument('--strays', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--data', help='directory for the synthetic masks, a temporary one by default')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run (--json) to compare against')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {result['name']: result for result in json.load(f)['results']}
+
+    print(f'{args.patients} patients of shape {tuple(args.shape)}, best and mean of {args.repeat}, per patient')
+    print(f'{"benchmark":<25} {"best ms":>10} {"mean ms":>10} {"peak MB":>9}')
+
+    if args.data:
+        results = run_benchmarks(args, args.data)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            results = run_benchmarks(args, data_dir)
+
+    if baseline is not None:
+        print(f'\ncompared to {args.compare} (commit {baseline_commit(args.compare)}), time ratio new/old')
+        for result in results:
+            if result['name'] in baseline:
+                print_result(result, baseline[result['name']])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(), 'arguments': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
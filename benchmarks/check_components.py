@@ -0,0 +1,264 @@
+""" Checks the labeling shortcuts of the QC against plain full-volume labeling on random masks.
+
+    Run from the repository root: python benchmarks/check_components.py --cases 500"""
+
+import argparse
+import os
+import sys
+
+import SimpleITK as sitk
+import cc3d
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'psqc'))
+
+from psqc_tools.components import (Components, foreground_bbox, label_background, label_components,  # noqa: E402
+                                   label_slices)
+from psqc_tools.functions import (filter_small_components, find_strays, label_array, patch_holes,  # noqa: E402
+                                  process_labels)
+from psqc_tools.scan_class import Scan  # noqa: E402
+
+CONNECTIVITIES = (6, 18, 26)
+# In-plane neighbours of every connectivity, as label_slices uses them
+PLANE_CONNECTIVITY = {6: 4, 18: 8, 26: 8}
+
+
+def random_mask(rng: np.random.Generator) -> np.ndarray:
+    """Random noise mask of a random small shape and density, with an empty margin of random width on every face,
+    so its foreground box is sometimes inside the volume and sometimes touches its border."""
+    core = rng.random(tuple(rng.integers(2, 12, 3))) < rng.uniform(0.05, 0.7)
+    return np.pad(core, [tuple(rng.integers(0, 3, 2)) for _ in range(3)])
+
+
+def full_labels(components: Components) -> np.ndarray:
+    """Label map of the components over the full volume."""
+    if components.slices is None:
+        return components.labels
+
+    labels = np.full(components.shape, components.outside_label, dtype=components.labels.dtype)
+    labels[components.slices] = components.labels
+
+    return labels
+
+
+def same_partition(labels: np.ndarray, reference: np.ndarray) -> bool:
+    """If two label maps split the volume into the same components, with label 0 on the same voxels."""
+    if not np.array_equal(labels == 0, reference == 0):
+        return False
+
+    pairs = np.unique(np.stack([labels.ravel(), reference.ravel()]), axis=1)
+
+    return pairs.shape[1] == len(np.unique(labels)) == len(np.unique(reference))
+
+
+def right_sizes(components: Components, labels: np.ndarray) -> bool:
+    """If the size of every component (label 0 excluded) is its number of voxels in labels."""
+    counts = np.bincount(labels.ravel(), minlength=len(components.sizes))
+
+    return len(counts) == len(components.sizes) and np.array_equal(counts[1:], components.sizes[1:])
+
+
+def check_background(rng: np.random.Generator) -> str:
+    """label_background (box with merged outside) and patch_holes against labeling the whole background."""
+    mask = random_mask(rng)
+    connectivity = int(rng.choice(CONNECTIVITIES))
+
+    components = label_background(mask, connectivity=connectivity)
+    labels = full_labels(components)
+    reference, n = cc3d.connected_components(~mask, connectivity=connectivity, return_N=True)
+    if not same_partition(labels, reference) or not right_sizes(components, labels):
+        return f'label_background differs, connectivity {connectivity}'
+
+    voxel_threshold = float(rng.choice([2, 10, 100]))
+    max_voxels = None if rng.random() < 0.5 else float(rng.integers(1, 20))
+    patched, _ = patch_holes(mask, voxel_threshold=voxel_threshold, connectivity=connectivity,
+                             max_voxels=max_voxels)
+
+    expected = mask
+    if n > 1:
+        sizes = np.bincount(reference.ravel(), minlength=n + 1)
+        sizes[0] = 0
+        largest = np.argmax(sizes)
+        holes = sizes < (sizes[largest] / voxel_threshold if max_voxels is None else max_voxels)
+        holes[[0, largest]] = False
+        expected = mask | holes[reference]
+
+    if not np.array_equal(patched > 0, expected):
+        return f'patch_holes differs, connectivity {connectivity}, threshold {voxel_threshold}, max {max_voxels}'
+
+    return None
+
+
+def slice_labels(mask: np.ndarray, connectivity: int) -> np.ndarray:
+    """Labels of the 2D components of every slice of mask, one labeling per slice, unique over the volume."""
+    labels = np.zeros(mask.shape, dtype=np.int64)
+    offset = 0
+    for z in range(mask.shape[0]):
+        # uint8, cc3d mislabels 2D bool images with 8-connectivity
+        plane, n = cc3d.connected_components(mask[z].astype(np.uint8), connectivity=PLANE_CONNECTIVITY[connectivity],
+                                             return_N=True)
+        labels[z] = np.where(plane > 0, plane + offset, 0)
+        offset += n
+
+    return labels
+
+
+def check_slices(rng: np.random.Generator) -> str:
+    """label_slices (all slices stacked into one labeling) and the slice-wise filter and patch against labeling
+    every slice on its own."""
+    mask = random_mask(rng)
+    connectivity = int(rng.choice(CONNECTIVITIES))
+
+    for background in (False, True):
+        target = ~mask if background else mask
+        reference = slice_labels(target, connectivity)
+        # The foreground box only holds all components of the foreground
+        for bbox in (None, foreground_bbox(mask)) if not background else (None,):
+            components = label_slices(mask, connectivity=connectivity, bbox=bbox, background=background)
+            labels = full_labels(components)
+            if not same_partition(labels, reference) or not right_sizes(components, labels):
+                return f'label_slices differs, connectivity {connectivity}, background {background}, box {bbox}'
+            if not np.array_equal(components.slice_of[labels[labels > 0]], np.nonzero(labels)[0]):
+                return f'slice_of differs, connectivity {connectivity}, background {background}, box {bbox}'
+
+    voxel_threshold = float(rng.choice([2, 10, 100]))
+    min_voxels = float(rng.choice([0, 2, 5]))
+    filtered, _ = filter_small_components(mask, voxel_threshold, connectivity=connectivity, min_voxels=min_voxels,
+                                          slice_wise=True)
+    max_voxels = None if rng.random() < 0.5 else float(rng.integers(1, 10))
+    patched, _ = patch_holes(mask, voxel_threshold=voxel_threshold, connectivity=connectivity, max_voxels=max_voxels,
+                             slice_wise=True)
+
+    expected_filtered = np.zeros_like(mask)
+    expected_patched = mask.copy()
+    for z in range(mask.shape[0]):
+        labels = slice_labels(mask[z:z + 1], connectivity)[0]
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        keep = sizes > sizes.max() / voxel_threshold
+        if min_voxels:
+            keep &= sizes >= min_voxels
+        keep |= sizes == sizes.max()
+        keep[0] = False
+        expected_filtered[z] = keep[labels]
+
+        labels = slice_labels(~mask[z:z + 1], connectivity)[0]
+        sizes = np.bincount(labels.ravel())
+        outside = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+        outside = outside[outside > 0]
+        holes = sizes < (sizes[outside].sum() / voxel_threshold if max_voxels is None else max_voxels)
+        holes[outside] = False
+        holes[0] = False
+        expected_patched[z] |= holes[labels]
+
+    if not np.array_equal(filtered > 0, expected_filtered):
+        return f'slice-wise filter differs, connectivity {connectivity}, threshold {voxel_threshold}, min {min_voxels}'
+    if not np.array_equal(patched > 0, expected_patched):
+        return f'slice-wise patch differs, connectivity {connectivity}, threshold {voxel_threshold}, max {max_voxels}'
+
+    return None
+
+
+def face_neighbours(mask: np.ndarray) -> np.ndarray:
+    """Voxels sharing a face with a voxel of mask."""
+    neighbours = np.zeros_like(mask)
+    for axis in range(mask.ndim):
+        lower = tuple(slice(None, -1) if i == axis else slice(None) for i in range(mask.ndim))
+        upper = tuple(slice(1, None) if i == axis else slice(None) for i in range(mask.ndim))
+        neighbours[upper] |= mask[lower]
+        neighbours[lower] |= mask[upper]
+
+    return neighbours
+
+
+def check_strays(rng: np.random.Generator) -> str:
+    """find_strays (sizes from the labels of the central zone, relabeling only split components) against labeling
+    the central zone within the whole mask again."""
+    central = random_mask(rng)
+    connectivity = int(rng.choice(CONNECTIVITIES))
+    # Whole masks holding entire components, or cutting some of them
+    whole = [np.ones_like(central), central | (rng.random(central.shape) < 0.3),
+             rng.random(central.shape) < 0.85][rng.integers(3)]
+    touching = None if rng.random() < 0.5 else (rng.random(central.shape) < 0.1) & ~central
+    voxel_threshold = float(rng.choice([2, 10, 100]))
+    min_voxels = float(rng.choice([0, 2, 5]))
+
+    components = label_components(central, connectivity=connectivity, bbox=foreground_bbox(central, margin=1))
+    strays, apart, voxels = find_strays(components, whole, voxel_threshold, connectivity=connectivity,
+                                        min_voxels=min_voxels, touching=touching)
+
+    labels, n = cc3d.connected_components(central & whole, connectivity=connectivity, return_N=True)
+    sizes = np.bincount(labels.ravel(), minlength=n + 1)
+    sizes[0] = 0
+    expected = np.zeros(n + 1, dtype=bool)
+    expected_apart = np.zeros(n + 1, dtype=bool)
+    if n > 1:
+        keep = sizes > sizes.max() / voxel_threshold
+        if min_voxels:
+            keep &= sizes >= min_voxels
+            keep[np.argmax(sizes)] = True
+        expected = (sizes != 0) & ~keep
+        if touching is not None:
+            touches = np.bincount(labels[face_neighbours(touching)], minlength=n + 1) > 0
+            expected_apart = expected & ~touches
+            expected &= touches
+
+    if not np.array_equal(strays, expected[labels]) or voxels != sizes[expected].sum():
+        return f'find_strays differs, connectivity {connectivity}, threshold {voxel_threshold}, min {min_voxels}'
+    if (apart is None) != (not expected_apart.any()) or (apart is not None and
+                                                         not np.array_equal(apart, expected_apart[labels])):
+        return f'strays apart from touching differ, connectivity {connectivity}'
+
+    return None
+
+
+def check_labels(rng: np.random.Generator) -> str:
+    """process_labels on a float64 multi-label mask (as some exports save them) against the same mask as integers,
+    and label_array rejecting fractional label values."""
+    mask = random_mask(rng)
+    labels = mask * rng.integers(1, 5, mask.shape)
+    ref = {'spacing': (0.5, 0.5, 3.0), 'origin': (0.0, 0.0, 0.0), 'direction': (1, 0, 0, 0, 1, 0, 0, 0, 1),
+           'pixel_type': sitk.sitkFloat64}
+    connectivity = int(rng.choice(CONNECTIVITIES))
+
+    expected, expected_stats = process_labels(Scan(array=labels.astype(np.int32), ref=ref), connectivity=connectivity)
+    result, stats = process_labels(Scan(array=labels.astype(np.float64), ref=ref), connectivity=connectivity)
+    if not np.array_equal(result.array, expected.array) or stats != expected_stats:
+        return f'float64 labels differ from integer ones, connectivity {connectivity}'
+
+    fractional = labels.astype(np.float64)
+    fractional.flat[rng.integers(fractional.size)] += 0.5
+    if label_array(fractional) is not None:
+        return 'fractional label values are not rejected'
+
+    return None
+
+
+CHECKS = {'background': check_background, 'slices': check_slices, 'strays': check_strays, 'labels': check_labels}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cases', type=int, default=500, help='random masks per check')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    failures = 0
+    for name, check in CHECKS.items():
+        failed = []
+        for case in range(args.cases):
+            problem = check(np.random.default_rng([args.seed, case]))
+            if problem is not None:
+                failed.append(f'case {case}: {problem}')
+
+        print(f'{name:>12} {args.cases - len(failed)}/{args.cases} random masks match')
+        for problem in failed[:10]:
+            print(f'{"":>12} {problem}')
+        failures += len(failed)
+
+    if failures:
+        raise Exception(f'{failures} random masks differ from full-volume labeling')
+
+
+if __name__ == '__main__':
+    main()
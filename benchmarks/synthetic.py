@@ -0,0 +1,155 @@
+""" Synthetic prostate-like zonal and lesion masks with a controlled number of defects.
+
+    Run from the repository root to write a dataset: python benchmarks/synthetic.py out_dir --patients 20"""
+
+import argparse
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+SPACING = (0.5, 0.5, 3.0)
+
+
+def _ellipsoid(shape: tuple, center: tuple, radii: tuple) -> np.ndarray:
+    zz, yy, xx = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    return ((zz - center[0]) / radii[0]) ** 2 + ((yy - center[1]) / radii[1]) ** 2 + \
+        ((xx - center[2]) / radii[2]) ** 2 < 1
+
+
+def _free_voxels(mask: np.ndarray, away_from: np.ndarray, n: int, rng: np.random.Generator) -> np.ndarray:
+    # Voxels on a stride-2 lattice outside away_from, so the single voxel defects never touch each other
+    lattice = np.zeros(mask.shape, dtype=bool)
+    lattice[::2, ::2, ::2] = True
+    candidates = np.flatnonzero(lattice & ~away_from)
+
+    return rng.choice(candidates, min(n, len(candidates)), replace=False)
+
+
+def zonal_masks(shape: tuple, fragments: int = 20, holes: int = 5, strays: int = 3, seed: int = 0) -> dict:
+    """Makes the zonal masks of one synthetic patient.
+
+    The whole gland is an ellipsoid, the central zone a smaller ellipsoid in its anterior part and the
+    peripheral zone the rest of the gland. Defects the QC has to fix are added on top:
+    fragments are single voxel PZ or CZ components away from the gland, holes are single voxel gaps inside
+    the zones and strays are small CZ islands inside the PZ.
+
+    Args:
+        shape (tuple): shape of the masks (z, y, x)
+        fragments (int, optional): number of fragments. Defaults to 20.
+        holes (int, optional): number of holes. Defaults to 5.
+        strays (int, optional): number of strays. Defaults to 3.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        dict: 'combined' (PZ=1, CZ=2), 'peripheral', 'central' and 'whole' uint8 arrays
+    """
+    rng = np.random.default_rng(seed)
+    center = np.array(shape) / 2 + rng.uniform(-0.05, 0.05, 3) * np.array(shape)
+    radii = np.array([shape[0] * 0.35, shape[1] * 0.12, shape[2] * 0.16]) * rng.uniform(0.9, 1.1, 3)
+
+    whole = _ellipsoid(shape, center, radii)
+    central = _ellipsoid(shape, center - [0, radii[1] * 0.25, 0], radii * [0.8, 0.6, 0.6]) & whole
+
+    combined = whole.astype(np.uint8)
+    combined[central] = 2
+
+    # Strays: CZ islands of 2x2x2 voxels in the posterior part of the PZ
+    pz = np.argwhere(combined[:-1, :-1, :-1] == 1)
+    posterior = pz[pz[:, 1] > center[1] + radii[1] * 0.5]
+    for z, y, x in posterior[rng.choice(len(posterior), min(strays, len(posterior)), replace=False)]:
+        combined[z:z + 2, y:y + 2, x:x + 2] = 2
+
+    # Holes: single voxels removed from the inside of the gland, both zones stay connected
+    inside = np.flatnonzero(_ellipsoid(shape, center, radii * 0.7))
+    combined.flat[rng.choice(inside, min(holes, len(inside)), replace=False)] = 0
+
+    # Fragments: single voxels of either zone well away from the gland
+    placed = _free_voxels(combined, _ellipsoid(shape, center, radii * 1.3), fragments, rng)
+    combined.flat[placed] = rng.integers(1, 3, len(placed))
+
+    return {'combined': combined, 'peripheral': (combined == 1).astype(np.uint8),
+            'central': (combined == 2).astype(np.uint8), 'whole': (combined > 0).astype(np.uint8)}
+
+
+def lesion_mask(shape: tuple, lesions: int = 2, fragments: int = 10, holes: int = 2, seed: int = 0) -> np.ndarray:
+    """Makes the lesion mask of one synthetic patient, lesions inside the gland of zonal_masks with the same seed.
+
+    Args:
+        shape (tuple): shape of the mask (z, y, x)
+        lesions (int, optional): number of lesions. Defaults to 2.
+        fragments (int, optional): number of single voxel fragments. Defaults to 10.
+        holes (int, optional): number of single voxel holes. Defaults to 2.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        np.ndarray: uint8 mask
+    """
+    rng = np.random.default_rng(seed)
+    center = np.array(shape) / 2
+    mask = np.zeros(shape, dtype=np.uint8)
+
+    cores = []
+    for _ in range(lesions):
+        core = center + rng.uniform(-0.1, 0.1, 3) * np.array(shape)
+        radii = np.array([shape[0] * 0.1, shape[1] * 0.03, shape[2] * 0.03]) * rng.uniform(0.8, 1.5, 3) + 1
+        mask[_ellipsoid(shape, core, radii)] = 1
+        cores.append(core.astype(int))
+
+    for core in cores[:holes]:
+        mask[tuple(core)] = 0
+
+    placed = _free_voxels(mask, _ellipsoid(shape, center, np.array(shape) * 0.3), fragments, rng)
+    mask.flat[placed] = 1
+
+    return mask
+
+
+def write_dataset(out_dir: str, patients: int, shape: tuple, extension: str = '.nii.gz', seed: int = 0,
+                  **defects) -> dict:
+    """Writes synthetic masks of every patient in the directory layout qc_zone and qc_lesion expect.
+
+    Args:
+        out_dir (str): where the combined, peripheral, central, whole and lesion directories are made
+        patients (int): number of patients
+        shape (tuple): shape of the masks (z, y, x)
+        extension (str, optional): file extension. Defaults to '.nii.gz'.
+        seed (int, optional): random seed of the first patient. Defaults to 0.
+        defects: fragments, holes and strays passed on to zonal_masks
+
+    Returns:
+        dict: path of every mask directory
+    """
+    dirs = {name: os.path.join(out_dir, name) for name in ['combined', 'peripheral', 'central', 'whole', 'lesion']}
+    for directory in dirs.values():
+        os.makedirs(directory, exist_ok=True)
+
+    for i in range(patients):
+        masks = zonal_masks(shape, seed=seed + i, **defects)
+        masks['lesion'] = lesion_mask(shape, seed=seed + i)
+
+        for name, array in masks.items():
+            image = sitk.GetImageFromArray(array)
+            image.SetSpacing(SPACING)
+            sitk.WriteImage(image, os.path.join(dirs[name], f'pt_{i + 1:04d}_{name}{extension}'))
+
+    return dirs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('out_dir')
+    parser.add_argument('--patients', type=int, default=20)
+    parser.add_argument('--shape', type=int, nargs=3, default=[24, 384, 384], help='mask shape (z y x)')
+    parser.add_argument('--fragments', type=int, default=20)
+    parser.add_argument('--holes', type=int, default=5)
+    parser.add_argument('--strays', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_dataset(args.out_dir, args.patients, tuple(args.shape), seed=args.seed,
+                  fragments=args.fragments, holes=args.holes, strays=args.strays)
+
+
+if __name__ == '__main__':
+    main()
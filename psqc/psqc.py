@@ -1,19 +1,266 @@
-from copy import deepcopy
+import json
+import time
+from functools import partial
 
 import pandas as pd
+
 from psqc_tools.filename_tools import *
 from tqdm import tqdm
-import numpy as np
 
-from psqc_tools.functions import filter_small_components, process_scan
-from psqc_tools.scan_class import Scan
-from psqc_tools.separate_masks import separate_masks
-from psqc_tools.join_masks import join_masks
+from psqc_tools.functions import (COUNT_COLUMNS, label_array, process_labels, process_scan, process_zones,
+                                  sweep_thresholds)
+from psqc_tools.scan_class import Scan, write_image
+from psqc_tools.separate_masks import separate_array
+from psqc_tools.join_masks import join_images
+from psqc_tools.parallel import imap_patients
+from psqc_tools.pipeline import BackgroundWriter, iter_patients
+from psqc_tools.cache import ResultCache, iter_cached
+from psqc_tools.change_log import (MANIFEST, ChangeLog, finalize_log, make_change_log_dir, read_log, read_manifest,
+                                  write_manifest)
+from psqc_tools.preflight import preflight_masks
+from psqc_tools.profiling import print_profile, profile_table
+
+
+def _drop_outputs(results, profile: bool):
+    """Results of iter_patients without the paths of the written masks."""
+    for result in results:
+        if profile:
+            (result, outputs), records = result
+            yield result, records
+        else:
+            result, outputs = result
+            yield result
+
+
+def _log_patients(results, log_path: str, profile: bool) -> tuple:
+    """Writes every (key, row) result to the ChangeLog at log_path as soon as it comes in. A log kept from an
+    earlier run (with a cache) only gets the rows it does not have yet, e.g. not those of patients taken from the
+    cache.
+
+    Returns:
+        tuple: (scan_names, stage records) of every patient if profile is set, otherwise empty lists
+    """
+    logged = read_log(log_path) if os.path.exists(log_path) else {}
+
+    scan_names, records = [], []
+    with ChangeLog(log_path) as log:
+        for result in results:
+            if profile:
+                result, patient_records = result
+                scan_names.append(result[1]['scan_name'])
+                records.append(patient_records)
+
+            key, row = result
+            if logged.get(key) != row:
+                log.write(key, row)
+
+    return scan_names, records
+
+
+def _write_profile(scan_names: list, records: list, change_log_loc: str, start: float) -> None:
+    """Saves the stage records of every patient next to the change log and prints their summary."""
+    profile_df = profile_table(scan_names, records)
+    profile_df.to_csv(os.path.join(change_log_loc, 'profile.csv'), index=False)
+    print_profile(profile_df, time.perf_counter() - start)
+
+
+def _change_log_base(shard: str = None) -> str:
+    # Shards run at the same time must not race for the same change_log_N directory
+    if shard is None:
+        return 'change_log'
+
+    index, count = parse_shard(shard)
+    return f'change_log_shard_{index}_of_{count}'
+
+
+def _preflight(names: list, mask_paths: list, change_log_loc: str, workers: int, kept_masks: tuple = ()) -> list:
+    """Checks the headers of every patient's masks, saves the problems found to preflight.csv next to the change
+    log and returns the indices of the patients to process.
+
+    Args:
+        names (list): scan_name of every patient
+        mask_paths (list): {mask name: path} of every patient
+        change_log_loc (str): where to save the report
+        workers (int): as in qc_zone
+        kept_masks (tuple, optional): masks that may differ from the others, a patient is only left out if one of
+            them cannot be read. Defaults to ().
+
+    Returns:
+        list: indices of the patients that passed
+    """
+    report = preflight_masks(list(zip(names, mask_paths)), workers=workers)
+    if report.empty:
+        print(f'Pre-flight: all {len(names)} patients passed')
+        return list(range(len(names)))
+
+    report.to_csv(os.path.join(change_log_loc, 'preflight.csv'), index=False)
+    excluded = set(report.loc[~(report['mask'].isin(kept_masks) & (report['check'] == 'match')), 'scan_name'])
+    for row in report.itertuples():
+        print(f'Warning: {row.path}: {row.problem}' + (', left out' if row.scan_name in excluded else ''))
+    print(f'Pre-flight: {len(excluded)} of {len(names)} patients left out, see preflight.csv')
+
+    return [i for i, name in enumerate(names) if name not in excluded]
+
+
+def _zone_tables(change_log_loc: str, check_whole: bool) -> dict:
+    """finalize_log tables of qc_zone, all changes and, for each zone, only the masks that were changed."""
+    whole_flags = ['whole_filtered', 'whole_patched'] + (['whole_mismatch'] if check_whole else [])
+    central_flags = ['central_filtered', 'central_patched', 'strays_converted']
+    perif_flags = ['perif_filtered', 'perif_patched', 'strays_converted']
+    columns = ['scan_name'] + whole_flags + perif_flags[:2] + central_flags + COUNT_COLUMNS
+
+    return {
+        os.path.join(change_log_loc, 'all_mods.csv'): (columns, []),
+        os.path.join(change_log_loc, 'whole_mods.csv'):
+            (['scan_name'] + whole_flags + ['whole_voxels_removed', 'whole_voxels_filled'], whole_flags),
+        os.path.join(change_log_loc, 'central_mods.csv'):
+            (['scan_name'] + central_flags + ['central_voxels_removed', 'central_voxels_filled',
+                                              'strays_voxels_converted'], central_flags),
+        os.path.join(change_log_loc, 'perif_mods.csv'):
+            (['scan_name'] + perif_flags + ['perif_voxels_removed', 'perif_voxels_filled',
+                                            'strays_voxels_converted'], perif_flags)}
+
+
+def _lesion_tables(change_log_loc: str, multi_label: bool = False) -> dict:
+    """finalize_log tables of qc_lesion, multi_label runs also log the patients skipped for fractional labels."""
+    columns = ['scan_name', 'lesion_filtered', 'lesion_patched', 'lesion_voxels_removed', 'lesion_voxels_filled']
+    if multi_label:
+        columns.append('skipped')
+    return {os.path.join(change_log_loc, 'lesion_mods.csv'): (columns, [])}
+
+
+def _write_label_table(log_path: str, change_log_loc: str) -> None:
+    """Writes lesion_labels.csv, the statistics of every label of every patient of a multi_label qc_lesion log."""
+    rows = read_log(log_path)
+    labels = [{'scan_name': rows[key]['scan_name'], **label,
+               **dict(zip(['centroid_z', 'centroid_y', 'centroid_x'], label.get('centroid', [])))}
+              for key in sorted(rows) for label in rows[key].get('labels', [])]
+    pd.DataFrame(labels, columns=['scan_name', 'label', 'components', 'voxels', 'volume_mm3', 'voxels_removed',
+                                  'voxels_filled', 'centroid_z', 'centroid_y', 'centroid_x']
+                 ).to_csv(os.path.join(change_log_loc, 'lesion_labels.csv'), index=False)
+
+
+def _print_totals(totals: dict) -> None:
+    for column, total in totals.items():
+        print(column, total)
+
+
+def _read_zone_patient(patient: tuple, whole_path: str, peripheral_path: str, central_path: str, combined_path: str,
+                       check_whole: bool) -> tuple:
+    """Reads the zonal masks of one patient. Module level so it can run in worker processes or a reader thread.
+
+    Args:
+        patient (tuple): as returned by pair_masks, (scan_name, pt_id) for combined masks, otherwise
+            (scan_name, pt_id, central_scan_name, perif_scan_name) with scan_name the filename in whole_path
+            (check_whole) or peripheral_path
+        other arguments: as in qc_zone
+
+    Returns:
+        tuple: (scan_name, pt_id, central_scan_name, perif_scan_name, central_scan, perif_scan, whole_scan0),
+            whole_scan0 is None if check_whole is False
+    """
+    if combined_path:
+        # Splits the combined mask in memory, so it is read only once
+        scan_name, pt_id = patient
+        central_scan_name = perif_scan_name = scan_name
+
+        combined_scan = Scan(path=os.path.join(combined_path, scan_name))
+        _, perif_array, central_array = separate_array(combined_scan.array)
+        central_scan = Scan(array=central_array, ref=combined_scan.ref)
+        perif_scan = Scan(array=perif_array, ref=combined_scan.ref)
+
+    else:
+        scan_name, pt_id, central_scan_name, perif_scan_name = patient
+
+        central_scan_path = os.path.join(central_path, central_scan_name)
+        central_scan = Scan(path=central_scan_path)
+
+        perif_scan_path = os.path.join(peripheral_path, perif_scan_name)
+        perif_scan = Scan(path=perif_scan_path)
+
+        # Only the headers are read so far, masks that cannot be processed together are not decoded
+        if central_scan.shape != perif_scan.shape:
+            raise Exception(f'Shape of {perif_scan_name} and {central_scan_name} do not match')
+        central_scan.load()
+        perif_scan.load()
+
+    whole_scan0 = None
+    if check_whole:
+        whole_scan_path = os.path.join(whole_path, scan_name)
+        whole_scan0 = Scan(path=whole_scan_path)
+        # A whole mask of another shape is reported as a mismatch without being decoded
+        if whole_scan0.shape == central_scan.shape:
+            whole_scan0.load()
+
+    return scan_name, pt_id, central_scan_name, perif_scan_name, central_scan, perif_scan, whole_scan0
+
+
+def _process_zone_patient(masks: tuple, to_save: bool, changed_only: bool, check_whole: bool, whole_out: str,
+                          peripheral_out: str, central_out: str, combined_out: str, pixel_type: int,
+                          filter_threshold: float = 10, hole_threshold: float = 100, connectivity: int = 6,
+                          min_component_mm3: float = None, max_hole_mm3: float = None, slice_wise: bool = False,
+                          strays_touching_pz: bool = False, out_extension: str = None, compression_level: int = None,
+                          writer: BackgroundWriter = None) -> tuple:
+    """Quality control on the zonal masks of one patient. Module level so it can run in worker processes.
+
+    Args:
+        masks (tuple): as returned by _read_zone_patient
+        combined_out (str): where to save combined masks, None to not save them
+        writer (BackgroundWriter, optional): writes the masks in the background. Defaults to None (write directly).
+        other arguments: as in qc_zone
+
+    Returns:
+        tuple: ((pt_id, row of the change log), paths of the written masks)
+    """
+    scan_name, pt_id, central_scan_name, perif_scan_name, central_scan, perif_scan, whole_scan0 = masks
+    write = writer.write if writer is not None else write_image
+
+    if check_whole and whole_scan0.shape != central_scan.shape:
+        tqdm.write(f'Something wrong with {scan_name}, the dimensions dont match between the different masks')
+
+    whole_scan_aug, perif_scan_aug, central_scan_aug, changes = process_zones(
+        perif_scan, central_scan, whole_scan0, filter_threshold=filter_threshold, hole_threshold=hole_threshold,
+        connectivity=connectivity, min_component_mm3=min_component_mm3, max_hole_mm3=max_hole_mm3,
+        slice_wise=slice_wise, strays_touching_pz=strays_touching_pz)
+    mismatch = changes.pop('whole_mismatch', False)
+
+    combined_pixel_type = central_scan_aug.pixel_type if pixel_type is None else pixel_type
+
+    outputs = []
+    # If changed_only is True, only write the files if there were changes else writes all files
+    if to_save and (not changed_only or mismatch or any(changes.values())):
+        if changed_only:
+            central_scan_name = perif_scan_name = scan_name
+
+        outputs = [os.path.join(whole_out, with_extension(scan_name, out_extension)),
+                   os.path.join(peripheral_out, with_extension(perif_scan_name, out_extension)),
+                   os.path.join(central_out, with_extension(central_scan_name, out_extension))]
+        whole_scan_aug.write_image(outputs[0], pixel_type, writer, compression_level)
+        perif_scan_aug.write_image(outputs[1], pixel_type, writer, compression_level)
+        central_scan_aug.write_image(outputs[2], pixel_type, writer, compression_level)
+
+        if combined_out:
+            outputs.append(os.path.join(combined_out, with_extension(perif_scan_name, out_extension)))
+            write(join_images(perif_scan_aug.image, central_scan_aug.image), outputs[-1], combined_pixel_type,
+                  compression_level)
+
+    # Returns row for the change log, logging all the findings
+    row = {'scan_name': scan_name, **changes}
+    if check_whole:
+        row['whole_mismatch'] = mismatch
+
+    return (pt_id, row), outputs
 
 
 def qc_zone(whole_path: str = None, peripheral_path: str = None, central_path: str = None, combined_path: str = None,
             to_save: bool = True, changed_only: bool = True, check_whole: bool = False, whole_out: str = 'out/whole', combine_output: bool = True,
-            peripheral_out: str = 'out/peripheral', central_out: str = 'out/central', combined_out: str = 'out/combined') -> None:
+            peripheral_out: str = 'out/peripheral', central_out: str = 'out/central', combined_out: str = 'out/combined',
+            workers: int = 1, chunksize: int = None, pixel_type: int = None, read_ahead: int = 0,
+            io_threads: int = 2, cache_dir: str = None, profile: bool = False, shard: str = None,
+            filter_threshold: float = 10, hole_threshold: float = 100, connectivity: int = 6,
+            min_component_mm3: float = None, max_hole_mm3: float = None, slice_wise: bool = False,
+            strays_touching_pz: bool = False, dry_run: bool = False, preflight: bool = True, out_extension: str = None,
+            compression_level: int = None) -> None:
     """Quality control on zonal masks.
 
     Args:
@@ -28,6 +275,48 @@ def qc_zone(whole_path: str = None, peripheral_path: str = None, central_path: s
         peripheral_out (str, optional): where to save peripheral mask. Defaults to 'out/peripheral'.
         central_out (str, optional): where to save central. Defaults to 'out/central'.
         combined_out (str, optional): where to save combined masks. Defaults to 'out/combined'.
+        workers (int, optional): number of processes to spread the patients over, None uses all cores. Defaults to 1.
+        chunksize (int, optional): patients sent to a worker process at once. Defaults to about 4 chunks per worker.
+        pixel_type (int, optional): SimpleITK pixel type of the written masks, e.g. sitk.sitkUInt8.
+            Defaults to None (same as the input masks).
+        read_ahead (int, optional): patients read ahead by a background thread while the current one is processed,
+            with outputs written by background threads. Only with workers=1. Defaults to 0 (no pipelining).
+        io_threads (int, optional): threads writing the output masks when read_ahead is set. Defaults to 2.
+        cache_dir (str, optional): where the result of every patient is stored, keyed by the content of its masks and
+            the QC parameters. A rerun only processes new or changed patients and adds them to the change log of
+            the last run with the same cache and parameters, an interrupted run resumes where it stopped. Defaults to None (no cache, everything is processed).
+        profile (bool, optional): to record the wall time, bytes read and written, voxels and peak RSS of every stage
+            (read, filter, patch, write) of every patient into profile.csv next to all_mods.csv, and print a summary
+            at the end. Defaults to False.
+        shard (str, optional): only process shard i of n ('i/n', e.g. '0/4'), split by patient id so separate jobs
+            with the same n process disjoint patients. The change log goes to change_log_shard_i_of_n.
+            Defaults to None (all patients).
+        filter_threshold (float, optional): components up to 1/filter_threshold of the largest one are removed.
+            Defaults to 10.
+        hole_threshold (float, optional): holes smaller than 1/hole_threshold of the outside background are filled.
+            Defaults to 100.
+        connectivity (int, optional): connectivity of the components and holes, 6, 18 or 26. Defaults to 6.
+            Use sweep to see how many patients other values would change.
+        min_component_mm3 (float, optional): components smaller than this volume (mm³, from the spacing of every
+            mask) are removed as well, except the largest one. Defaults to None.
+        max_hole_mm3 (float, optional): holes smaller than this volume (mm³) are filled, instead of those smaller
+            than 1/hole_threshold of the outside background. Defaults to None.
+        slice_wise (bool, optional): to filter and patch every slice on its own, with 2D components and holes, for
+            masks with thick slices whose in-plane holes open to a neighbouring slice. All slices are labeled in
+            one call. Defaults to False.
+        strays_touching_pz (bool, optional): to only convert the central zone strays that share a voxel face with
+            the peripheral zone, the others are removed from the central zone and the whole mask. Defaults to False.
+        dry_run (bool, optional): to only find and log the changes, without writing or even building any masks
+            or creating the output directories, e.g. to audit a read-only archive. Defaults to False.
+        preflight (bool, optional): to check the size, spacing, origin and direction of every patient's masks from
+            their headers before processing any, leaving out the patients whose zonal masks are unreadable or do not
+            match. The problems are saved to preflight.csv next to all_mods.csv, a whole mask that does not match
+            is only logged as a mismatch. Defaults to True.
+        out_extension (str, optional): extension, and with it the format, of the written masks, e.g. '.nii' to
+            skip compression, '.mhd' for a header with raw pixel data, '.npz' or '.npy' (raw store) for numpy.
+            Defaults to None (same as the input masks).
+        compression_level (int, optional): 0 to write uncompressed, 1 (fastest) to 9 (smallest) where the format
+            compresses (.nii.gz, .mhd, .npz). Defaults to None (default of the format).
 
     """
     # Check if variables are sound:
@@ -40,216 +329,159 @@ def qc_zone(whole_path: str = None, peripheral_path: str = None, central_path: s
         raise Exception(
             'If checking whole scan match, whole_path must be specified')
 
-    if os.path.exists(whole_out):
-        print('Warning: "out" folder already exists, files may be overwritten. Stop code now to avoid this.')
+    # A dry run only writes the change log, the output directories are not even created
+    if dry_run:
+        to_save = False
 
-    os.makedirs(whole_out, exist_ok=True)
-    os.makedirs(peripheral_out, exist_ok=True)
-    os.makedirs(central_out, exist_ok=True)
+    else:
+        if os.path.exists(whole_out):
+            print('Warning: "out" folder already exists, files may be overwritten. Stop code now to avoid this.')
+
+        os.makedirs(whole_out, exist_ok=True)
+        os.makedirs(peripheral_out, exist_ok=True)
+        os.makedirs(central_out, exist_ok=True)
+
+    read = partial(_read_zone_patient, whole_path=whole_path, peripheral_path=peripheral_path, central_path=central_path,
+                   combined_path=combined_path, check_whole=check_whole)
+    process = partial(_process_zone_patient, to_save=to_save, changed_only=changed_only, check_whole=check_whole,
+                      whole_out=whole_out, peripheral_out=peripheral_out, central_out=central_out,
+                      combined_out=combined_out if combine_output else None, pixel_type=pixel_type,
+                      filter_threshold=filter_threshold, hole_threshold=hole_threshold, connectivity=connectivity,
+                      min_component_mm3=min_component_mm3, max_hole_mm3=max_hole_mm3, slice_wise=slice_wise,
+                      strays_touching_pz=strays_touching_pz, out_extension=out_extension,
+                      compression_level=compression_level)
+    cache = ResultCache(cache_dir, params={'mode': 'zone', **read.keywords, **process.keywords}) if cache_dir else None
+
+    # With a cache the change log of its last run with the same parameters is kept and updated
+    change_log_loc = make_change_log_dir(_change_log_base(shard), owner=cache.owner if cache else None)
 
-    if os.path.exists('change_log'):
-        suffix = 1
-        while True:
-            if os.path.exists('change_log' + '_' + str(suffix)):
-                suffix += 1
-            else:
-                break
-        os.makedirs('change_log' + '_' + str(suffix), exist_ok=True)
-        change_log_loc = 'change_log' + '_' + str(suffix)
-        print('saving change_log to: change_log_' + str(suffix))
+    if check_whole:
+        scan_names = list_masks(whole_path)
     else:
-        os.makedirs('change_log', exist_ok=True)
-        change_log_loc = 'change_log'
-        print('saving change_log to: change_log')
+        scan_names = list_masks(combined_path or peripheral_path)
+    scan_names = shard_masks(scan_names, shard)
 
-    # If combined scans provided, separate them:
     if combined_path:
-        if os.path.exists('temp'):
-            print('Warning: "temp" folder already exists, if error occurs, delete "temp" folder and restart code.')
-        print('Separating combined masks into peripheral, central, and whole masks...')
-        separate_masks(orig=combined_path, OUT='temp')
-        peripheral_path = 'temp/peripheral'
-        central_path = 'temp/central'
-        whole_path = 'temp/whole'
-
-    # Create dataframe to store all changes
+        patients = pair_masks(scan_names)
+    else:
+        # Finds matching masks in other folders, each folder is listed only once
+        patients = pair_masks(scan_names, PatientIndex(central_path), PatientIndex(peripheral_path))
 
-    if check_whole:
-        scan_names = sorted(i for i in os.listdir(
-            whole_path) if i.endswith(('.nii.gz', '.nii', '.mhd')))
-        df = pd.DataFrame(columns=['scan_name', 'whole_filtered', 'whole_patched', 'whole_mismatch', 'perif_filtered',
-                                   'perif_patched', 'central_filtered', 'central_patched', 'strays_converted'])
+    # The input masks of every patient, the first one is the one the others have to match
+    if combined_path:
+        mask_paths = [{'combined': os.path.join(combined_path, scan_name)} for scan_name, pt_id in patients]
     else:
-        scan_names = sorted(i for i in os.listdir(
-            peripheral_path) if i.endswith(('.nii.gz', '.nii', '.mhd')))
-        df = pd.DataFrame(columns=['scan_name', 'whole_filtered', 'whole_patched', 'perif_filtered',
-                                   'perif_patched', 'central_filtered', 'central_patched', 'strays_converted'])
+        mask_paths = [{'central': os.path.join(central_path, central_scan_name),
+                       'peripheral': os.path.join(peripheral_path, perif_scan_name),
+                       **({'whole': os.path.join(whole_path, scan_name)} if check_whole else {})}
+                      for scan_name, pt_id, central_scan_name, perif_scan_name in patients]
+
+    if preflight:
+        # A whole mask of another geometry is only logged as a mismatch
+        passed = _preflight([patient[0] for patient in patients], mask_paths, change_log_loc, workers,
+                            kept_masks=('whole',))
+        patients = [patients[i] for i in passed]
+        mask_paths = [mask_paths[i] for i in passed]
+
+    if shard is not None:
+        write_manifest(change_log_loc, shard, [patient[1] for patient in patients])
+
+    if combine_output and not dry_run:
+        os.makedirs(combined_out, exist_ok=True)
 
     print('Starting quality control...')
-    for scan_name in tqdm(scan_names):
-        # Finds patient id to find matching mask in other folders
-        try:
-            pt_id = find_seq_num(scan_name)
-        except:
-            try:
-                pt_id = find_seq_num(scan_name, number_of_digits=3).zfill(4)
-            except:
-                pt_id = find_seq_num(scan_name, number_of_digits=2).zfill(4)
-
-        central_scan_name = find_scan_name(pt_id, central_path)
-        central_scan_path = os.path.join(central_path, central_scan_name)
-        central_scan = Scan(path=central_scan_path)
+    start = time.perf_counter()
 
-        perif_scan_name = find_scan_name(pt_id, peripheral_path)
-        perif_scan_path = os.path.join(peripheral_path, perif_scan_name)
-        perif_scan = Scan(path=perif_scan_path)
-
-        # Create another 'whole' scan to make all the three masks match up
-        whole_scan_array = np.zeros(central_scan.array.shape)
-        whole_scan_array[(central_scan.array == 1) |
-                         (perif_scan.array == 1)] = 1
-        whole_scan = Scan(array=whole_scan_array, ref=central_scan.image)
-        mismatch = False
-
-        if check_whole:
-            whole_scan_path = os.path.join(whole_path, scan_name)
-            whole_scan0 = Scan(path=whole_scan_path)
-
-            try:
-                whole_test = whole_scan.array - whole_scan0.array
-                if np.count_nonzero(whole_test) != 0:
-                    mismatch = True
-            except Exception as e:
-                tqdm.write(
-                    f'{e} \n Something wrong with {scan_name}, possibly the dimensions dont match between the different masks')
-
-        # Processes whole prostate mask
-        whole_scan_aug = process_scan(
-            whole_scan, to_patch_holes=True, to_filter_small_components=True)
-
-        # Processes central zone mask
-
-        central_scan_aug = process_scan(
-            central_scan, to_patch_holes=True, to_filter_small_components=True)
-
-        # Finds small components in central zone mask that are included in the processed whole prostate mask
-        central_array_base = central_scan.array
-        central_array_aug0 = deepcopy(central_array_base)
-        central_array_aug0[whole_scan_aug.array == 0] = 0
-        filtered_central_array, converted_strays = filter_small_components(
-            central_array_aug0)
-
-        # Does initial processing of peripheral zone mask
-
-        perif_scan_aug_raw = process_scan(
-            perif_scan, to_patch_holes=True, to_filter_small_components=True, whole_to_compare=whole_scan_aug)
-
-        # Adds the small components that were in the central zone mask and in the processed whole prostate mask.
-        # These are considered 'strays' and are believed to be erroneously included in the central zone mask.
-        perif_strays = central_array_aug0 - filtered_central_array
-        perif_array_aug = perif_scan_aug_raw.array + perif_strays
-        perif_scan_aug = Scan(array=perif_array_aug, ref=perif_scan.image)
-
-        # Now to check for (unlikely) holes in the prostate mask that are on the border between PZ and CZ.
-
-        post_combined_whole = np.zeros(perif_scan_aug.array.shape)
-        post_combined_whole[perif_scan_aug.array > 0] = 1
-        post_combined_whole[central_scan_aug.array > 0] = 1
-
-        if np.array_equal(post_combined_whole, whole_scan_aug.array):
-            new_central_array = central_scan_aug.array.copy()
-            new_central_array[(central_scan_aug.array == 0) & (whole_scan_aug.array != 0)] = 1
-
-            central_scan_aug.array = new_central_array
-            central_scan_aug.patched == True
-
-        if to_save:
-            # If changed_only is True, only write the files if there were changes else writes all files
-            if changed_only:
-                if check_whole:
-                    if any((whole_scan_aug.filtered, whole_scan_aug.patched, mismatch, perif_scan_aug_raw.filtered, perif_scan_aug_raw.patched, central_scan_aug.filtered, central_scan_aug.patched, converted_strays)):
-                        whole_scan_aug.write_image(
-                            os.path.join(whole_out, scan_name))
-                        perif_scan_aug.write_image(
-                            os.path.join(peripheral_out, scan_name))
-                        central_scan_aug.write_image(
-                            os.path.join(central_out, scan_name))
-                else:
-                    if any((whole_scan_aug.filtered, whole_scan_aug.patched, perif_scan_aug_raw.filtered, perif_scan_aug_raw.patched, central_scan_aug.filtered, central_scan_aug.patched, converted_strays)):
-                        whole_scan_aug.write_image(
-                            os.path.join(whole_out, scan_name))
-                        perif_scan_aug.write_image(
-                            os.path.join(peripheral_out, scan_name))
-                        central_scan_aug.write_image(
-                            os.path.join(central_out, scan_name))
-
-            else:
-                whole_scan_aug.write_image(os.path.join(whole_out, scan_name))
-                central_scan_aug.write_image(
-                    os.path.join(central_out, central_scan_name))
-                perif_scan_aug.write_image(
-                    os.path.join(peripheral_out, perif_scan_name))
-
-        # Adds row to dataframe, logging all the findings
-        if check_whole:
-            df.loc[pt_id] = {'scan_name': scan_name,
-                             'whole_filtered': whole_scan_aug.filtered, 'whole_patched': whole_scan_aug.patched, 'whole_mismatch': mismatch,
-                             'perif_filtered': perif_scan_aug_raw.filtered, 'perif_patched': perif_scan_aug_raw.patched,
-                             'central_filtered': central_scan_aug.filtered, 'central_patched': central_scan_aug.patched,
-                             'strays_converted': converted_strays}
-        else:
-            df.loc[pt_id] = {'scan_name': scan_name,
-                             'whole_filtered': whole_scan_aug.filtered, 'whole_patched': whole_scan_aug.patched,
-                             'perif_filtered': perif_scan_aug_raw.filtered, 'perif_patched': perif_scan_aug_raw.patched,
-                             'central_filtered': central_scan_aug.filtered, 'central_patched': central_scan_aug.patched,
-                             'strays_converted': converted_strays}
+    if cache:
+        input_paths = [list(paths.values()) for paths in mask_paths]
+        results = iter_cached(read, process, patients, input_paths, cache, workers=workers, chunksize=chunksize,
+                              read_ahead=read_ahead, io_threads=io_threads, profile=profile)
+    else:
+        results = _drop_outputs(iter_patients(read, process, patients, workers=workers, chunksize=chunksize,
+                                              read_ahead=read_ahead, io_threads=io_threads, profile=profile), profile)
 
-    # Saves information about all changes to a csv file
-    df.sort_index(inplace=True)
-    df.to_csv(os.path.join(change_log_loc, 'all_mods.csv'))
+    scan_names, records = _log_patients(results, os.path.join(change_log_loc, 'all_mods.jsonl'), profile)
 
-    # Creates new csv files for each zone, including only masks that were changed and logs the changes
-    if check_whole:
-        whole_df = df[['scan_name', 'whole_filtered',
-                       'whole_patched', 'whole_mismatch']]
-        whole_df = whole_df[(whole_df['whole_filtered'] == True) | (
-            whole_df['whole_patched'] == True) | (whole_df['whole_mismatch'] == True)]
-    else:
-        whole_df = df[['scan_name', 'whole_filtered',
-                       'whole_patched']]
-        whole_df = whole_df[(whole_df['whole_filtered'] == True) | (
-            whole_df['whole_patched'] == True)]
+    # Writes all changes and, for each zone, only the masks that were changed, keeping the patients of earlier runs
+    # logged in the same directory
+    _print_totals(finalize_log(os.path.join(change_log_loc, 'all_mods.jsonl'),
+                               _zone_tables(change_log_loc, check_whole)))
 
-    whole_df.to_csv(os.path.join(change_log_loc, 'whole_mods.csv'))
+    if profile:
+        _write_profile(scan_names, records, change_log_loc, start)
 
-    central_df = df[['scan_name', 'central_filtered',
-                     'central_patched', 'strays_converted']]
-    central_df = central_df[(central_df['central_filtered'] == True) | (
-        central_df['central_patched'] == True) | (central_df['strays_converted'] == True)]
-    central_df.to_csv(os.path.join(change_log_loc, 'central_mods.csv'))
 
-    perif_df = df[['scan_name', 'perif_filtered',
-                   'perif_patched', 'strays_converted']]
-    perif_df = perif_df[(perif_df['perif_filtered'] == True) | (
-        perif_df['perif_patched'] == True) | (perif_df['strays_converted'] == True)]
-    perif_df.to_csv(os.path.join(change_log_loc, 'perif_mods.csv'))
+def _read_lesion_patient(scan_name: str, lesions_path: str) -> tuple:
+    """Reads the lesion mask of one patient. Module level so it can run in worker processes or a reader thread.
 
-    for column in df.columns[1:]:
-        print(column, df[column].sum())
+    Returns:
+        tuple: (scan_name, lesion_scan)
+    """
+    scan_path = os.path.join(lesions_path, scan_name)
+    return scan_name, Scan(path=scan_path).load()
 
-    if combined_path:
-        try:
-            os.remove('temp')
-        except Exception as e:
-            print('Could not remove temp dir because: ', e)
 
-    if combine_output:
-        os.makedirs(combined_out, exist_ok=True)
-        print()
-        join_masks(peripheral_out, central_out, combined_out)
+def _process_lesion_patient(masks: tuple, to_save: bool, changed_only: bool, lesions_out: str, pixel_type: int,
+                            filter_threshold: float = 10, hole_threshold: float = 100, connectivity: int = 6,
+                            min_component_mm3: float = None, max_hole_mm3: float = None, slice_wise: bool = False,
+                            multi_label: bool = False, out_extension: str = None, compression_level: int = None,
+                            writer: BackgroundWriter = None) -> tuple:
+    """Quality control on the lesion mask of one patient. Module level so it can run in worker processes.
 
+    Args:
+        masks (tuple): as returned by _read_lesion_patient
+        writer (BackgroundWriter, optional): writes the masks in the background. Defaults to None (write directly).
+        other arguments: as in qc_lesion
 
-def qc_lesion(lesions_path: str, to_save: bool = True, changed_only: bool = True, lesions_out: str = 'out/lesions') -> None:
+    Returns:
+        tuple: ((scan_name, row of the change log), paths of the written masks)
+    """
+    scan_name, lesion_scan = masks
+    if multi_label:
+        array = label_array(lesion_scan.array)
+        if array is None:
+            # Logged and skipped, one such mask does not stop the run
+            tqdm.write(f'Skipping {scan_name}, it has fractional label values')
+            row = {'scan_name': scan_name, 'lesion_filtered': False, 'lesion_patched': False,
+                   'lesion_voxels_removed': 0, 'lesion_voxels_filled': 0, 'labels': [],
+                   'skipped': True}
+            return (scan_name, row), []
+
+        if array is not lesion_scan.array:
+            lesion_scan = Scan(array=array, ref=lesion_scan.ref, pixel_type=lesion_scan.pixel_type)
+        lesion_aug, labels = process_labels(lesion_scan, filter_threshold=filter_threshold,
+                                            hole_threshold=hole_threshold, connectivity=connectivity,
+                                            min_component_mm3=min_component_mm3, max_hole_mm3=max_hole_mm3)
+    else:
+        lesion_aug = process_scan(
+            lesion_scan, to_patch_holes=True, to_filter_small_components=True, filter_threshold=filter_threshold,
+            hole_threshold=hole_threshold, connectivity=connectivity, min_component_mm3=min_component_mm3,
+            max_hole_mm3=max_hole_mm3, slice_wise=slice_wise)
+
+    outputs = []
+    # If changed_only is True, only write the files if there were changes else writes all files
+    if to_save and (not changed_only or lesion_aug.filtered or lesion_aug.patched):
+        outputs = [os.path.join(lesions_out, with_extension(scan_name, out_extension))]
+        lesion_aug.write_image(outputs[0], pixel_type, writer, compression_level)
+
+    # Returns row for the change log, logging all the findings
+    row = {'scan_name': scan_name,
+           'lesion_filtered': lesion_aug.filtered, 'lesion_patched': lesion_aug.patched,
+           'lesion_voxels_removed': lesion_aug.removed, 'lesion_voxels_filled': lesion_aug.filled,
+           }
+    if multi_label:
+        row['labels'] = labels
+
+    return (scan_name, row), outputs
+
+
+def qc_lesion(lesions_path: str, to_save: bool = True, changed_only: bool = True, lesions_out: str = 'out/lesions',
+              workers: int = 1, chunksize: int = None, pixel_type: int = None, read_ahead: int = 0,
+              io_threads: int = 2, cache_dir: str = None, profile: bool = False, shard: str = None,
+              filter_threshold: float = 10, hole_threshold: float = 100, connectivity: int = 6,
+              min_component_mm3: float = None, max_hole_mm3: float = None, slice_wise: bool = False,
+              dry_run: bool = False, preflight: bool = True, multi_label: bool = False, out_extension: str = None,
+              compression_level: int = None) -> None:
     """Perform quality control on lesion masks.
 
     Args:
@@ -257,10 +489,37 @@ def qc_lesion(lesions_path: str, to_save: bool = True, changed_only: bool = True
         to_save (bool, optional): to save changed masks or not. Defaults to True.
         changed_only (bool, optional): if save to only save changed masks or all. Defaults to True.
         lesions_out (str, optional): where to save out masks. Defaults to 'out/lesions'.
+        workers (int, optional): number of processes to spread the patients over, None uses all cores. Defaults to 1.
+        chunksize (int, optional): patients sent to a worker process at once. Defaults to about 4 chunks per worker.
+        pixel_type (int, optional): SimpleITK pixel type of the written masks, e.g. sitk.sitkUInt8.
+            Defaults to None (same as the input masks).
+        read_ahead (int, optional): patients read ahead by a background thread while the current one is processed,
+            with outputs written by background threads. Only with workers=1. Defaults to 0 (no pipelining).
+        io_threads (int, optional): threads writing the output masks when read_ahead is set. Defaults to 2.
+        cache_dir (str, optional): where the result of every patient is stored, as in qc_zone. Defaults to None.
+        profile (bool, optional): to record the stages of every patient into profile.csv, as in qc_zone.
+            Defaults to False.
+        shard (str, optional): only process shard i of n ('i/n'), as in qc_zone. Defaults to None (all patients).
+        filter_threshold, hole_threshold, connectivity, min_component_mm3, max_hole_mm3, slice_wise (optional): as in
+            qc_zone. slice_wise can not be combined with multi_label.
+        dry_run (bool, optional): to only find and log the changes, as in qc_zone. Defaults to False.
+        preflight (bool, optional): to check the headers of all masks first, leaving out those that are unreadable
+            or not valid 3D masks, as in qc_zone. Defaults to True.
+        multi_label (bool, optional): to keep the label values of the masks (e.g. one per lesion, or PI-RADS
+            scores) instead of binarizing them, filtering the components of every label relative to its own largest
+            one. Float masks are cast to integers if all their values are whole, masks with fractional values are
+            skipped and logged as skipped. The statistics of every label, including its volume in mm³ and centroid,
+            are saved to lesion_labels.csv. Defaults to False.
+        out_extension, compression_level (optional): format and compression of the written masks, as in qc_zone.
     """
     # Check if variables are sound:
+    if multi_label and slice_wise:
+        raise Exception('slice_wise can not be combined with multi_label')
+
+    if dry_run:
+        to_save = False
 
-    if os.path.exists(lesions_out):
+    elif os.path.exists(lesions_out):
         suffix = 1
         while True:
             if os.path.exists(lesions_out + '_' + str(suffix)):
@@ -273,53 +532,202 @@ def qc_lesion(lesions_path: str, to_save: bool = True, changed_only: bool = True
         os.makedirs(lesions_out, exist_ok=True)
         print('saving lesions to: ', lesions_out)
 
-    if os.path.exists('change_log'):
-        suffix = 1
-        while True:
-            if os.path.exists('change_log' + '_' + str(suffix)):
-                suffix += 1
-            else:
-                break
-        os.makedirs('change_log' + '_' + str(suffix), exist_ok=True)
-        print('saving lesions to: change_log_' + str(suffix))
+    read = partial(_read_lesion_patient, lesions_path=lesions_path)
+    process = partial(_process_lesion_patient, to_save=to_save, changed_only=changed_only,
+                      lesions_out=lesions_out, pixel_type=pixel_type, filter_threshold=filter_threshold,
+                      hole_threshold=hole_threshold, connectivity=connectivity, min_component_mm3=min_component_mm3,
+                      max_hole_mm3=max_hole_mm3, slice_wise=slice_wise, multi_label=multi_label,
+                      out_extension=out_extension, compression_level=compression_level)
+    cache = ResultCache(cache_dir, params={'mode': 'lesion', **read.keywords, **process.keywords}) if cache_dir else None
+
+    # With a cache the change log of its last run with the same parameters is kept and updated
+    change_log_loc = make_change_log_dir(_change_log_base(shard), owner=cache.owner if cache else None)
+
+    scan_names = shard_masks(list_masks(lesions_path), shard)
+    if preflight:
+        passed = _preflight(scan_names, [{'lesion': os.path.join(lesions_path, scan_name)} for scan_name in scan_names],
+                            change_log_loc, workers)
+        scan_names = [scan_names[i] for i in passed]
+    if shard is not None:
+        write_manifest(change_log_loc, shard, scan_names)
+
+    start = time.perf_counter()
+
+    if cache:
+        input_paths = [[os.path.join(lesions_path, scan_name)] for scan_name in scan_names]
+        results = iter_cached(read, process, scan_names, input_paths, cache, workers=workers, chunksize=chunksize,
+                              read_ahead=read_ahead, io_threads=io_threads, profile=profile)
     else:
-        os.makedirs('change_log', exist_ok=True)
-        print('saving lesions to: change_log')
+        results = _drop_outputs(iter_patients(read, process, scan_names, workers=workers, chunksize=chunksize,
+                                              read_ahead=read_ahead, io_threads=io_threads, profile=profile), profile)
 
-    # Create dataframe to store all changes
-    scan_names = sorted(i for i in os.listdir(
-        lesions_path) if i.endswith(('.nii.gz', '.nii', '.mhd')))
+    scan_names, records = _log_patients(results, os.path.join(change_log_loc, 'lesion_mods.jsonl'), profile)
 
-    df = pd.DataFrame(
-        columns=['scan_name', 'lesion_filtered', 'lesion_patched'])
+    # Saves information about all changes to a csv file, keeping the patients of earlier runs logged in the same
+    # directory
+    _print_totals(finalize_log(os.path.join(change_log_loc, 'lesion_mods.jsonl'),
+                               _lesion_tables(change_log_loc, multi_label), number_rows=True))
+    if multi_label:
+        _write_label_table(os.path.join(change_log_loc, 'lesion_mods.jsonl'), change_log_loc)
 
-    for i, scan_name in enumerate(tqdm(scan_names)):
+    if profile:
+        _write_profile(scan_names, records, change_log_loc, start)
 
-        scan_path = os.path.join(lesions_path, scan_name)
-        lesion_scan = Scan(path=scan_path)
-        lesion_aug = process_scan(
-            lesion_scan, to_patch_holes=True, to_filter_small_components=True)
 
-        if to_save:
-            # If changed_only is True, only write the files if there were changes else writes all files
-            if changed_only:
-                if lesion_aug.filtered or lesion_aug.patched:
-                    lesion_aug.write_image(
-                        os.path.join(lesions_out, scan_name))
+def merge_shards(change_log_dirs: list, out: str = 'change_log_merged', strict: bool = False) -> dict:
+    """Merges the change logs of the shards of a qc_zone or qc_lesion run (one change_log_shard_i_of_n directory
+    per shard) into the change logs of a single run, all_mods.csv and the zone logs or lesion_mods.csv.
 
-            else:
-                lesion_aug.write_image(
-                    os.path.join(lesions_out, scan_name))
+    Patients logged by more than one shard, patients a shard was assigned but did not log (e.g. its job was
+    killed) and shards missing from change_log_dirs are reported. A shard can be rerun with the same spec and
+    the merge repeated. If several directories are the same shard, e.g. a shard and its rerun, only the one
+    logged last is merged.
+
+    Args:
+        change_log_dirs (list): change log directories of the shards
+        out (str, optional): name of the merged change log directory, a new out_1, out_2... is made if it exists.
+            Defaults to 'change_log_merged'.
+        strict (bool, optional): to raise an exception instead of merging if anything is reported.
+            Defaults to False.
+
+    Returns:
+        dict: report with the overlapping keys and the logs they are in ('overlaps'), the keys each shard did not
+            log ('missing') and the indices of the shards not given ('missing_shards')
+    """
+    if not change_log_dirs:
+        raise Exception('No change log directories to merge')
+
+    journals = []
+    for change_log_dir in change_log_dirs:
+        found = [name for name in ('all_mods.jsonl', 'lesion_mods.jsonl')
+                 if os.path.exists(os.path.join(change_log_dir, name))]
+        if len(found) != 1:
+            raise Exception(f'{change_log_dir} does not hold the change log of a qc_zone or qc_lesion run')
+        journals.append(found[0])
+
+    if len(set(journals)) > 1:
+        raise Exception('Cannot merge the change logs of qc_zone and qc_lesion runs')
+    journal = journals[0]
+
+    # Which shards were given and which patients each of them was assigned
+    manifests = [read_manifest(change_log_dir) for change_log_dir in change_log_dirs]
+    shards = {}
+    for change_log_dir, manifest in zip(change_log_dirs, manifests):
+        if manifest is None:
+            print(f'Warning: {change_log_dir} has no {MANIFEST}, its missing patients cannot be checked')
+            continue
+        index, count = parse_shard(manifest['shard'])
+        if index in shards:
+            # A shard rerun without a cache logs into a new directory (change_log_shard_i_of_n_1...), which a
+            # glob also matches. Its newest log is the one of the rerun.
+            older, newer = sorted([shards[index], change_log_dir],
+                                  key=lambda d: os.path.getmtime(os.path.join(d, journal)))
+            print(f'Warning: {older} and {newer} are both shard {manifest["shard"]}, keeping the newer {newer}')
+            change_log_dir = newer
+        shards[index] = change_log_dir
+
+    kept = [(change_log_dir, manifest) for change_log_dir, manifest in zip(change_log_dirs, manifests)
+            if manifest is None or change_log_dir in shards.values()]
+    change_log_dirs, manifests = [change_log_dir for change_log_dir, _ in kept], [manifest for _, manifest in kept]
+
+    counts = {parse_shard(manifest['shard'])[1] for manifest in manifests if manifest is not None}
+    if len(counts) > 1:
+        raise Exception(f'Shards of runs split {" and ".join(str(i) for i in sorted(counts))} ways cannot be merged')
+    missing_shards = sorted(set(range(counts.pop())) - set(shards)) if counts else []
+
+    paths = [os.path.join(change_log_dir, journal) for change_log_dir in change_log_dirs]
+    logs = [read_log(path) for path in paths]
+    missing = {change_log_dir: sorted(set(manifest['keys']) - set(rows))
+               for change_log_dir, manifest, rows in zip(change_log_dirs, manifests, logs)
+               if manifest is not None and set(manifest['keys']) - set(rows)}
+
+    merged, sources = {}, {}
+    for path, rows in zip(paths, logs):
+        for key, row in rows.items():
+            merged.setdefault(key, row)
+            sources.setdefault(key, []).append(path)
+    overlaps = {key: sources[key] for key in sorted(sources) if len(sources[key]) > 1}
+
+    for key, logged_by in overlaps.items():
+        print(f'Warning: {key} is logged by several shards, keeping the first: {", ".join(logged_by)}')
+    for change_log_dir, keys in missing.items():
+        print(f'Warning: {change_log_dir} did not log {len(keys)} of its patients: {", ".join(keys)}')
+    if missing_shards:
+        print(f'Warning: shards {", ".join(str(i) for i in missing_shards)} are missing')
+
+    report = {'overlaps': overlaps, 'missing': missing, 'missing_shards': missing_shards}
+    if strict and (overlaps or missing or missing_shards):
+        raise Exception('Shards could not be merged cleanly, see the warnings above')
+
+    change_log_loc = make_change_log_dir(out)
+    with open(os.path.join(change_log_loc, 'merge_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    with ChangeLog(os.path.join(change_log_loc, journal)) as log:
+        for key in sorted(merged):
+            log.write(key, merged[key])
+
+    if journal == 'all_mods.jsonl':
+        check_whole = any('whole_mismatch' in row for row in merged.values())
+        totals = finalize_log(os.path.join(change_log_loc, journal), _zone_tables(change_log_loc, check_whole))
+    else:
+        multi_label = any('labels' in row for row in merged.values())
+        totals = finalize_log(os.path.join(change_log_loc, journal), _lesion_tables(change_log_loc, multi_label),
+                              number_rows=True)
+        if multi_label:
+            _write_label_table(os.path.join(change_log_loc, journal), change_log_loc)
+    _print_totals(totals)
+
+    return report
 
-        # Adds row to dataframe, logging all the findings
-        df.loc[i] = {'scan_name': scan_name,
-                     'lesion_filtered': lesion_aug.filtered, 'lesion_patched': lesion_aug.patched,
-                     }
 
-    # Saves information about all changes to a csv file
-    df.sort_index(inplace=True)
-    df.to_csv('change_log/lesion_mods.csv')
+def _sweep_patient(scan_name: str, masks_path: str, filter_thresholds: list, hole_thresholds: list,
+                   connectivities: list) -> list:
+    """Threshold sweep of one mask. Module level so it can run in worker processes."""
+    scan = Scan(path=os.path.join(masks_path, scan_name))
+    return [{'scan_name': scan_name, **row}
+            for row in sweep_thresholds(scan.array, filter_thresholds, hole_thresholds, connectivities)]
 
-    # Creates new csv files for each zone, including only masks that were changed and logs the changes
-    for column in df.columns[1:]:
-        print(column, df[column].sum())
+
+def sweep(masks_path: str, filter_thresholds: list = (5, 10, 20), hole_thresholds: list = (50, 100, 200),
+          connectivities: list = (6, 26), out: str = 'sweep.csv', workers: int = 1, shard: str = None) -> pd.DataFrame:
+    """Counts the masks every combination of filter_threshold, hole_threshold and connectivity would change, to
+    tune them without a run of qc_zone or qc_lesion per setting. Every mask is read and labeled once per
+    connectivity, nothing is written but the table.
+
+    Nonzero voxels are the foreground, so lesion masks and combined zone masks (giving the whole prostate mask
+    qc_zone derives from them) can be swept directly, as can the directory of any single zone.
+
+    Args:
+        masks_path (str): path to the masks
+        filter_thresholds (list, optional): filter_threshold values. Defaults to (5, 10, 20).
+        hole_thresholds (list, optional): hole_threshold values. Defaults to (50, 100, 200).
+        connectivities (list, optional): connectivity values. Defaults to (6, 26).
+        out (str, optional): where to save the table, None to not save it. Defaults to 'sweep.csv'.
+        workers (int, optional): number of processes to spread the masks over, None uses all cores. Defaults to 1.
+        shard (str, optional): only sweep shard i of n ('i/n'), as in qc_zone. Defaults to None (all masks).
+
+    Returns:
+        pd.DataFrame: for every setting, the number of masks it would remove voxels from, fill holes in and change
+            in any way and the voxels it would remove and fill over all masks
+    """
+    scan_names = shard_masks(list_masks(masks_path), shard)
+    sweep_mask = partial(_sweep_patient, masks_path=masks_path, filter_thresholds=list(filter_thresholds),
+                         hole_thresholds=list(hole_thresholds), connectivities=list(connectivities))
+
+    rows = [row for rows in imap_patients(sweep_mask, scan_names, workers=workers) for row in rows]
+    df = pd.DataFrame(rows, columns=['scan_name', 'connectivity', 'filter_threshold', 'hole_threshold',
+                                     'voxels_removed', 'voxels_filled'])
+    df['filtered'] = df['voxels_removed'] > 0
+    df['patched'] = df['voxels_filled'] > 0
+    df['changed'] = df['filtered'] | df['patched']
+
+    summary = df.groupby(['connectivity', 'filter_threshold', 'hole_threshold'], as_index=False).agg(
+        masks_filtered=('filtered', 'sum'), masks_patched=('patched', 'sum'), masks_changed=('changed', 'sum'),
+        voxels_removed=('voxels_removed', 'sum'), voxels_filled=('voxels_filled', 'sum'))
+
+    if out:
+        summary.to_csv(out, index=False)
+        print('saving sweep to: ' + out)
+
+    return summary
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+from functools import partial
+
+from psqc_tools.mask_io import backend_of
+from psqc_tools.pipeline import iter_patients
+
+# Bump when a change to the QC would change the results for the same inputs, so old entries are not reused
+CACHE_VERSION = 3
+
+_HASH_CHUNK = 1 << 20
+
+
+def hash_files(paths: list) -> str:
+    """Hashes the content of the files (sha256), including the files they point to (e.g. the pixel data of .mhd
+    headers, the sidecars of the raw store).
+
+    Args:
+        paths (list): paths of the files
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        for data_file in backend_of(path).data_files(path):
+            with open(data_file, 'rb') as f:
+                for chunk in iter(partial(f.read, _HASH_CHUNK), b''):
+                    digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def fingerprint(path: str) -> dict:
+    """Size and modification time of every file of a written mask and the hash of their content, to tell if the
+    mask was changed since (e.g. overwritten by a run with other parameters)."""
+    stats = [os.stat(data_file) for data_file in backend_of(path).data_files(path)]
+
+    return {'path': path, 'sizes': [stat.st_size for stat in stats],
+            'mtimes_ns': [stat.st_mtime_ns for stat in stats], 'sha256': hash_files([path])}
+
+
+def _unchanged(output: dict) -> bool:
+    # Same sizes and times are taken as unchanged without reading the mask, other times only if the content is
+    try:
+        stats = [os.stat(data_file) for data_file in backend_of(output['path']).data_files(output['path'])]
+    except OSError:
+        return False
+
+    if [stat.st_size for stat in stats] != output['sizes']:
+        return False
+    if [stat.st_mtime_ns for stat in stats] == output['mtimes_ns']:
+        return True
+
+    return hash_files([output['path']]) == output['sha256']
+
+
+class ResultCache:
+    """Per-patient QC results on disk, keyed by the content of the input masks and the QC parameters.
+
+    Every patient is stored as its own json file as soon as its masks are written, so an interrupted run can be
+    resumed. A stored result is only reused if all the masks it wrote still exist and are unchanged.
+    """
+
+    def __init__(self, directory: str, params: dict):
+        self.directory = directory
+        self._params = json.dumps(params, sort_keys=True, default=str)
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def owner(self) -> str:
+        """Id of the cache directory and the QC parameters, for the change log kept with it (make_change_log_dir)."""
+        return hashlib.sha256(f'{os.path.abspath(self.directory)}\n{self._params}'.encode()).hexdigest()
+
+    def key(self, input_paths: list) -> str:
+        """Cache key of a patient, from the content of its input masks and the QC parameters."""
+        digest = hashlib.sha256(f'{CACHE_VERSION}\n{self._params}\n'.encode())
+        digest.update(hash_files(input_paths).encode())
+
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key: str):
+        """Stored result of the patient, None if there is none or its outputs are gone or changed."""
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not all(_unchanged(output) for output in entry['outputs']):
+            return None
+
+        return entry['result']
+
+    def put(self, key: str, result, outputs: list) -> None:
+        """Stores the result of the patient, outputs are the paths of the masks it wrote, which have to be written
+        by now."""
+        outputs = [fingerprint(output) for output in outputs]
+        path = self._path(key)
+        # Written under another name first, so an interrupted write never leaves a broken entry
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'result': result, 'outputs': outputs}, f, default=lambda o: o.item())
+        os.replace(path + '.tmp', path)
+
+
+def _read_keyed(item: tuple, read) -> tuple:
+    key, patient = item
+    return key, read(patient)
+
+
+def _process_keyed(keyed_masks: tuple, process, cache: ResultCache, writer=None):
+    key, masks = keyed_masks
+    result, outputs = process(masks, writer=writer)
+    if writer is None:
+        cache.put(key, result, outputs)
+    else:
+        # The masks are only queued, the result is stored once they are written so a crash never leaves an entry
+        # for missing or partly written masks
+        writer.after_writes(partial(cache.put, key, result, outputs))
+
+    return result
+
+
+def iter_cached(read, process, items: list, input_paths: list, cache: ResultCache, profile: bool = False,
+                **kwargs):
+    """Like pipeline.iter_patients, but reuses the stored results of patients whose inputs and parameters are
+    unchanged, and yields every result in order as soon as it is known.
+
+    Args:
+        read (callable): as in pipeline.iter_patients
+        process (callable): as in pipeline.iter_patients, but returning (result, paths of the written masks)
+        items (list): items to process
+        input_paths (list): for every item, the list of its input mask paths
+        cache (ResultCache): where results are stored
+        profile (bool, optional): as in pipeline.iter_patients, patients taken from the cache have no stage
+            records. Defaults to False.
+        kwargs: passed on to pipeline.iter_patients
+
+    Yields:
+        results, in the order of items
+    """
+    keys = [cache.key(paths) for paths in input_paths]
+    results = [cache.get(key) for key in keys]
+    todo = [i for i, result in enumerate(results) if result is None]
+
+    print(f'{len(items) - len(todo)} patients unchanged since the last run, processing {len(todo)}')
+
+    new_results = iter_patients(partial(_read_keyed, read=read), partial(_process_keyed, process=process, cache=cache),
+                                [(keys[i], items[i]) for i in todo], profile=profile, **kwargs)
+
+    for result in results:
+        if result is None:
+            yield next(new_results)
+        elif profile:
+            yield result, []
+        else:
+            yield result
+
+    # Lets the pipeline finish after its last result, e.g. wait for the last masks to be written
+    for _ in new_results:
+        pass
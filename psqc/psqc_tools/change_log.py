@@ -0,0 +1,154 @@
+import csv
+import json
+import os
+from contextlib import ExitStack
+
+# Written into the change log directory of every shard
+MANIFEST = 'shard.json'
+# Written into a change log directory that is kept across runs, e.g. for a result cache
+OWNER = 'owner.json'
+
+
+def _read_owner(change_log_loc: str) -> str:
+    try:
+        with open(os.path.join(change_log_loc, OWNER)) as f:
+            return json.load(f)['owner']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def make_change_log_dir(base: str = 'change_log', owner: str = None) -> str:
+    """Creates the directory for the change logs.
+
+    Args:
+        base (str, optional): name of the directory. Defaults to 'change_log'.
+        owner (str, optional): what the change logs are kept for across runs, e.g. a result cache and the QC
+            parameters (ResultCache.owner). The first of base, base_1, base_2... that is new or was made for the
+            same owner is used, a directory of another run is never written into. Defaults to None (always a new
+            directory).
+
+    Returns:
+        str: path of the directory
+    """
+    change_log_loc = base
+
+    suffix = 0
+    while os.path.exists(change_log_loc) and (owner is None or _read_owner(change_log_loc) != owner):
+        suffix += 1
+        change_log_loc = base + '_' + str(suffix)
+
+    os.makedirs(change_log_loc, exist_ok=True)
+    if owner is not None:
+        with open(os.path.join(change_log_loc, OWNER), 'w') as f:
+            json.dump({'owner': owner}, f)
+    print('saving change_log to: ' + change_log_loc)
+
+    return change_log_loc
+
+
+class ChangeLog:
+    """Append-only change log, one json line per patient written and flushed as soon as the patient is done,
+    so an interrupted run keeps the log of every patient it finished.
+
+    Opening an existing log appends to it, a later line of the same patient replaces the earlier one.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'a')
+
+    def write(self, key, row: dict) -> None:
+        """Logs the row of a patient, key is what the finalized logs are indexed and sorted by."""
+        self._file.write(json.dumps({'key': key, **row}, default=lambda o: o.item()) + '\n')
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_log(path: str) -> dict:
+    """Reads a ChangeLog.
+
+    Args:
+        path (str): path of the log
+
+    Returns:
+        dict: last row of every patient by key
+    """
+    rows = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                # The last line of a run that was killed while writing it
+                continue
+            rows[row.pop('key')] = row
+
+    return rows
+
+
+def finalize_log(path: str, tables: dict, number_rows: bool = False) -> dict:
+    """Writes the csv change logs from a ChangeLog, in a single pass over the patients sorted by key.
+
+    Args:
+        path (str): path of the ChangeLog
+        tables (dict): {csv path: (columns, flag columns)}, a patient is written to a table if any of its flag
+            columns is True, tables without flag columns get every patient
+        number_rows (bool, optional): to index the csv files with a running number instead of the key.
+            Defaults to False.
+
+    Returns:
+        dict: total of every column except scan_name over all patients
+    """
+    rows = read_log(path)
+    totals = {column: 0 for table_columns, flags in tables.values() for column in table_columns
+              if column != 'scan_name'}
+
+    with ExitStack() as stack:
+        writers = {}
+        for table, (table_columns, flags) in tables.items():
+            writer = csv.writer(stack.enter_context(open(table, 'w', newline='')), lineterminator='\n')
+            writer.writerow([''] + table_columns)
+            writers[table] = writer
+
+        for number, key in enumerate(sorted(rows)):
+            row = rows[key]
+            for column in totals:
+                if isinstance(row.get(column), (bool, int, float)):
+                    totals[column] += row[column]
+
+            for table, (table_columns, flags) in tables.items():
+                if not flags or any(row.get(flag) is True for flag in flags):
+                    writers[table].writerow([number if number_rows else key] + [row.get(i, '') for i in table_columns])
+
+    return totals
+
+
+def write_manifest(change_log_loc: str, shard: str, keys: list) -> None:
+    """Records the shard a change log directory belongs to and the keys of the patients assigned to it, before
+    any of them is processed, so a merge can tell which patients a failed shard did not get to.
+
+    Args:
+        change_log_loc (str): change log directory of the shard
+        shard (str): shard spec 'i/n'
+        keys (list): keys the patients of the shard are logged by
+    """
+    with open(os.path.join(change_log_loc, MANIFEST), 'w') as f:
+        json.dump({'shard': shard, 'keys': list(keys)}, f)
+
+
+def read_manifest(change_log_loc: str) -> dict:
+    """Manifest written by write_manifest, None if the directory has none (e.g. it is not from a sharded run)."""
+    try:
+        with open(os.path.join(change_log_loc, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
@@ -0,0 +1,187 @@
+import argparse
+import json
+import sys
+
+""" Command line entry point, psqc zone|lesion|sweep|separate|join|merge. The QC modules (and with them numpy, SimpleITK, cc3d,
+    pandas...) are only imported once a command runs, so --help and argument errors return immediately."""
+
+PIXEL_TYPES = ['UInt8', 'Int8', 'UInt16', 'Int16', 'UInt32', 'Int32', 'Float32', 'Float64']
+
+# Paths every command needs, from the command line or the config file
+REQUIRED = {'lesion': ['lesions_path'], 'sweep': ['masks_path'], 'separate': ['orig', 'OUT'], 'join': ['peripheral_dir', 'central_dir', 'out_dir'],
+            'merge': ['change_log_dirs']}
+
+
+def _pixel_type(name: str) -> int:
+    import SimpleITK as sitk
+
+    for pixel_type in PIXEL_TYPES:
+        if pixel_type.lower() == name.lower():
+            return getattr(sitk, 'sitk' + pixel_type)
+
+    raise Exception(f'Unknown pixel type {name}, pick one of {", ".join(PIXEL_TYPES)}')
+
+
+def _add_format_options(parser: argparse.ArgumentParser) -> None:
+    # Format of the written masks, for every command that writes masks
+    parser.add_argument('--out-extension',
+                        help='write the masks in another format, e.g. .nii (uncompressed), .mhd, .npz or .npy')
+    parser.add_argument('--compression-level', type=int, choices=range(10), metavar='{0-9}',
+                        help='0 for uncompressed, 1 (fastest) to 9 (smallest) where the format compresses')
+
+
+def _add_run_options(parser: argparse.ArgumentParser) -> None:
+    # Options shared by zone and lesion. Defaults are None so that only options given on the command line
+    # override the config file, the functions' own defaults apply otherwise.
+    parser.add_argument('--all', dest='changed_only', action='store_false', default=None,
+                        help='save all masks, not only the changed ones')
+    parser.add_argument('--no-save', dest='to_save', action='store_false', default=None, help='only write the logs')
+    parser.add_argument('--dry-run', action='store_true', default=None,
+                        help='only write the logs, without building any masks or creating the output directories')
+    parser.add_argument('--workers', type=int, help='processes to spread the patients over, 0 for all cores')
+    parser.add_argument('--chunksize', type=int, help='patients sent to a worker process at once')
+    parser.add_argument('--read-ahead', type=int, help='patients read ahead by a background thread (workers=1)')
+    parser.add_argument('--io-threads', type=int, help='threads writing the masks when reading ahead')
+    parser.add_argument('--cache-dir', help='reuse the results of unchanged patients stored here')
+    parser.add_argument('--profile', action='store_true', default=None, help='record the time of every stage')
+    parser.add_argument('--no-preflight', dest='preflight', action='store_false', default=None,
+                        help='do not check the headers of all masks before processing')
+    parser.add_argument('--shard', help='only process shard i of n (i/n, from 0), split by patient id')
+    parser.add_argument('--pixel-type', help=f'pixel type of the written masks ({", ".join(PIXEL_TYPES)})')
+    _add_format_options(parser)
+    parser.add_argument('--filter-threshold', type=float,
+                        help='remove components up to 1/threshold of the largest one (default 10)')
+    parser.add_argument('--hole-threshold', type=float,
+                        help='fill holes smaller than 1/threshold of the outside background (default 100)')
+    parser.add_argument('--connectivity', type=int, choices=[6, 18, 26], help='of components and holes (default 6)')
+    parser.add_argument('--min-component-mm3', type=float,
+                        help='also remove components smaller than this volume, except the largest one')
+    parser.add_argument('--max-hole-mm3', type=float,
+                        help='fill holes smaller than this volume instead of using --hole-threshold')
+    parser.add_argument('--slice-wise', action='store_true', default=None,
+                        help='filter and patch every slice on its own, with 2D components and holes')
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='psqc', description='Quality control of prostate segmentation masks.')
+    parser.add_argument('--config', help='json file with the options of every command, e.g. {"zone": {"workers": 4}}, '
+                                         'options given on the command line take precedence')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    zone = commands.add_parser('zone', help='QC of zonal masks')
+    inputs = zone.add_argument_group('input, either --combined or --peripheral and --central')
+    inputs.add_argument('--combined', dest='combined_path', help='combined masks (pz=1, cz=2)')
+    inputs.add_argument('--whole', dest='whole_path', help='whole prostate masks')
+    inputs.add_argument('--peripheral', dest='peripheral_path', help='peripheral zone masks')
+    inputs.add_argument('--central', dest='central_path', help='central zone masks')
+    zone.add_argument('--check-whole', action='store_true', default=None,
+                      help='check if the whole masks match the zonal masks')
+    zone.add_argument('--no-combine', dest='combine_output', action='store_false', default=None,
+                      help='do not write combined masks')
+    zone.add_argument('--strays-touching-pz', action='store_true', default=None,
+                      help='only convert central zone strays that touch the peripheral zone')
+    zone.add_argument('--whole-out')
+    zone.add_argument('--peripheral-out')
+    zone.add_argument('--central-out')
+    zone.add_argument('--combined-out')
+    _add_run_options(zone)
+
+    lesion = commands.add_parser('lesion', help='QC of lesion masks')
+    lesion.add_argument('lesions_path', nargs='?', help='lesion masks')
+    lesion.add_argument('--out', dest='lesions_out')
+    lesion.add_argument('--multi-label', action='store_true', default=None,
+                        help='keep the label values, QC every label on its own')
+    _add_run_options(lesion)
+
+    sweep = commands.add_parser('sweep', help='count the masks every threshold and connectivity would change')
+    sweep.add_argument('masks_path', nargs='?', help='lesion, combined zone or single zone masks')
+    sweep.add_argument('--filter-thresholds', type=float, nargs='+')
+    sweep.add_argument('--hole-thresholds', type=float, nargs='+')
+    sweep.add_argument('--connectivities', type=int, nargs='+', choices=[6, 18, 26])
+    sweep.add_argument('--out', help='where to save the table (default sweep.csv)')
+    sweep.add_argument('--workers', type=int, help='processes to spread the masks over, 0 for all cores')
+    sweep.add_argument('--shard', help='only sweep shard i of n (i/n)')
+
+    separate = commands.add_parser('separate', help='split combined masks into whole, peripheral and central masks')
+    separate.add_argument('orig', nargs='?', help='combined masks (pz=1, cz=2)')
+    separate.add_argument('OUT', nargs='?', help='where the whole, peripheral and central directories are made')
+    separate.add_argument('--pixel-type')
+    _add_format_options(separate)
+
+    join = commands.add_parser('join', help='join peripheral and central zone masks into combined masks')
+    join.add_argument('peripheral_dir', nargs='?')
+    join.add_argument('central_dir', nargs='?')
+    join.add_argument('out_dir', nargs='?')
+    join.add_argument('--pixel-type')
+    _add_format_options(join)
+
+    merge = commands.add_parser('merge', help='merge the change logs of the shards of a zone or lesion run')
+    merge.add_argument('change_log_dirs', nargs='*', default=None, help='change log directories of the shards')
+    merge.add_argument('--out', help='merged change log directory')
+    merge.add_argument('--strict', action='store_true', default=None,
+                       help='fail instead of merging if patients overlap or are missing')
+
+    return parser
+
+
+def options(args: argparse.Namespace) -> dict:
+    """Keyword arguments of the command, from the config file section of the command and the command line."""
+    kwargs = {}
+    if args.config:
+        with open(args.config) as f:
+            kwargs.update(json.load(f).get(args.command, {}))
+
+    kwargs.update({key: value for key, value in vars(args).items()
+                   if value is not None and key not in ('config', 'command')})
+
+    if isinstance(kwargs.get('pixel_type'), str):
+        kwargs['pixel_type'] = _pixel_type(kwargs['pixel_type'])
+    if kwargs.get('workers') == 0:
+        kwargs['workers'] = None
+
+    return kwargs
+
+
+def main(argv: list = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    kwargs = options(args)
+
+    missing = [key for key in REQUIRED.get(args.command, []) if not kwargs.get(key)]
+    if args.command == 'zone' and not (kwargs.get('combined_path') or
+                                       (kwargs.get('peripheral_path') and kwargs.get('central_path'))):
+        missing.append('--combined or --peripheral and --central')
+    if missing:
+        parser.error(f'{args.command}: missing {", ".join(missing)}')
+
+    if args.command == 'zone':
+        from psqc import qc_zone
+        qc_zone(**kwargs)
+
+    elif args.command == 'lesion':
+        from psqc import qc_lesion
+        qc_lesion(**kwargs)
+
+    elif args.command == 'sweep':
+        from psqc import sweep
+        print(sweep(**kwargs).to_string(index=False))
+
+    elif args.command == 'separate':
+        from psqc_tools.separate_masks import separate_masks
+        separate_masks(**kwargs)
+
+    elif args.command == 'join':
+        from psqc_tools.join_masks import join_masks
+        join_masks(**kwargs)
+
+    elif args.command == 'merge':
+        from psqc import merge_shards
+        report = merge_shards(**kwargs)
+        if any(report.values()):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
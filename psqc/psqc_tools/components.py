@@ -0,0 +1,325 @@
+import cc3d
+import numpy as np
+
+_COUNT_CHUNK = 1 << 20
+
+# In-plane connectivity of label_slices, the 3D connectivities give their neighbours within a slice
+_PLANE_CONNECTIVITY = {4: 4, 8: 8, 6: 4, 18: 8, 26: 8}
+
+
+class Components:
+    """Connected components of a mask, stored as one label map and a table of voxel counts.
+
+    Label 0 is the background of the labeled mask, components are labeled 1..n. The label map may cover only
+    a box (slices) of the full volume (shape), everything outside it then belongs to outside_label (0 if the
+    outside is not part of any component). Components labeled slice by slice (label_slices) also have the slice
+    index of every label in slice_of.
+    """
+
+    def __init__(self, labels: np.ndarray, sizes: np.ndarray, slices: tuple = None, shape: tuple = None,
+                 outside_label: int = 0, slice_of: np.ndarray = None):
+        self.labels = labels
+        self.sizes = sizes
+        self.slices = slices
+        self.shape = labels.shape if shape is None else shape
+        self.outside_label = outside_label
+        self.slice_of = slice_of
+        self._stats = None
+
+    @property
+    def n(self) -> int:
+        """Number of components (background excluded)."""
+        return len(self.sizes) - 1
+
+    @property
+    def biggest(self) -> int:
+        """Voxel number of the largest component, 0 if there are none."""
+        return int(self.sizes[1:].max()) if self.n else 0
+
+    def stats(self) -> dict:
+        """Table of the voxel number and centroid of every component, made in one pass over the label map the
+        first time it is asked for. Centroids only cover the part of a component within slices.
+
+        Returns:
+            dict: voxels (n + 1) and centroid (n + 1, 3), in voxel indices of the full volume in array order
+                (z, y, x)
+        """
+        if self._stats is None:
+            centroid = cc3d.statistics(self.labels, no_slice_conversion=True)['centroids']
+            if self.slices is not None:
+                centroid = centroid + np.array([i.start for i in self.slices])
+
+            self._stats = {'voxels': self.sizes, 'centroid': centroid}
+
+        return self._stats
+
+    def select(self, keep: np.ndarray, dtype=bool) -> np.ndarray:
+        """Builds a mask of the chosen components with a single lookup-table remap.
+
+        Args:
+            keep (np.ndarray): boolean array over all labels (length n + 1), True for components to keep
+            dtype (optional): dtype of the returned mask. Defaults to bool.
+
+        Returns:
+            np.ndarray: mask of the full volume with 1 where the voxel belongs to a kept component
+        """
+        lut = np.asarray(keep, dtype=dtype).copy()
+        lut[0] = 0
+
+        if self.slices is None:
+            return lut[self.labels]
+
+        mask = np.full(self.shape, lut[self.outside_label], dtype=dtype)
+        mask[self.slices] = lut[self.labels]
+
+        return mask
+
+    def ranked(self, k: int = None) -> np.ndarray:
+        """Orders the component labels by decreasing voxel number, ties broken by label.
+
+        With k set only the k largest labels are returned. They are chosen with a linear-time
+        partition around the k-th largest size and only those candidates are sorted, which gives
+        exactly the first k entries of the full ranking.
+
+        Args:
+            k (int, optional): number of largest components to return. Defaults to None (all).
+
+        Returns:
+            np.ndarray: component labels, largest first
+        """
+        sizes = self.sizes[1:]
+
+        if k is None or k >= self.n:
+            return np.argsort(-sizes, kind='stable') + 1
+
+        if k <= 0:
+            return np.zeros(0, dtype=np.intp)
+
+        kth = np.partition(sizes, self.n - k)[self.n - k]
+        candidates = np.flatnonzero(sizes >= kth)
+        order = candidates[np.argsort(-sizes[candidates], kind='stable')]
+
+        return order[:k] + 1
+
+
+def foreground_bbox(array: np.ndarray, margin: int = 0) -> tuple:
+    """Finds the bounding box of the nonzero voxels.
+
+    Args:
+        array (np.ndarray): mask array
+        margin (int, optional): voxels added on every side, as far as the volume allows. Defaults to 0.
+
+    Returns:
+        tuple: one slice per axis, None if the mask is empty
+    """
+    z_any = np.flatnonzero(array.any(axis=(1, 2)))
+    if len(z_any) == 0:
+        return None
+
+    # The in-plane extent is only searched within the slices that have foreground
+    plane = array[z_any[0]:z_any[-1] + 1].any(axis=0)
+    y_any = np.flatnonzero(plane.any(axis=1))
+    x_any = np.flatnonzero(plane.any(axis=0))
+
+    return tuple(slice(max(found[0] - margin, 0), min(found[-1] + 1 + margin, size))
+                 for found, size in zip((z_any, y_any, x_any), array.shape))
+
+
+def _count_voxels(labels: np.ndarray, N: int) -> np.ndarray:
+    # bincount casts its input to intp, counting in chunks keeps that temporary small
+    flat = labels.ravel()
+    sizes = np.zeros(N + 1, dtype=np.int64)
+    for start in range(0, flat.size, _COUNT_CHUNK):
+        sizes += np.bincount(flat[start:start + _COUNT_CHUNK], minlength=N + 1)
+
+    return sizes
+
+
+def label_components(array: np.ndarray, connectivity: int = 6, bbox: tuple = None) -> Components:
+    """Labels the connected components of the mask once and counts the voxels of all of them in one pass.
+
+    Every component is labeled, there is no cap on their number, and the cost is linear in the
+    number of voxels.
+
+    Args:
+        array (np.ndarray): mask in array format
+        connectivity (int, optional): Define the connectivity directions. Defaults to 6.
+        bbox (tuple, optional): slices of a box containing all the foreground, only the box is labeled.
+            Defaults to None (whole volume).
+
+    Returns:
+        Components: label map and voxel number of every component
+    """
+    cropped = array if bbox is None else array[bbox]
+
+    labels, N = cc3d.connected_components(
+        cropped, connectivity=connectivity, return_N=True)
+
+    return Components(labels, _count_voxels(labels, N), slices=bbox, shape=array.shape)
+
+
+def label_slices(array: np.ndarray, connectivity: int = 6, bbox: tuple = None,
+                 background: bool = False) -> Components:
+    """Labels the 2D connected components of every slice (first axis) of the mask, all slices in one labeling call.
+
+    The slices are stacked into a single 2D image with a row of zeros between neighbours, so components never
+    join across slices, and labeled at once instead of one call per slice.
+
+    Args:
+        array (np.ndarray): mask in array format
+        connectivity (int, optional): 4 or 8, or the 3D connectivity whose in-plane neighbours to use (6 gives 4,
+            18 and 26 give 8). Defaults to 6.
+        bbox (tuple, optional): slices of the box to label. Defaults to None (whole volume).
+        background (bool, optional): to label the voxels equal to 0 instead of the foreground. Defaults to False.
+
+    Returns:
+        Components: label map, voxel number and slice index (slice_of, 0 for label 0) of every component
+    """
+    cropped = array if bbox is None else array[bbox]
+    depth, height, width = cropped.shape
+
+    stacked = np.zeros((depth, height + 1, width), dtype=bool if background else cropped.dtype)
+    if background:
+        np.equal(cropped, 0, out=stacked[:, :height])
+    else:
+        stacked[:, :height] = cropped
+
+    # cc3d (4.1) leaves gaps in the labels of 2D bool images with 8-connectivity, a uint8 view is labeled right
+    stacked = stacked.view(np.uint8) if stacked.dtype == bool else stacked
+    labels, N = cc3d.connected_components(stacked.reshape(depth * (height + 1), width),
+                                          connectivity=_PLANE_CONNECTIVITY[connectivity], return_N=True)
+    sizes = _count_voxels(labels, N)
+    # The separator rows are counted as label 0, the labels of the slices are a view without them
+    sizes[0] -= depth * width
+    labels = labels.reshape(depth, height + 1, width)
+    first_slice = 0 if bbox is None else bbox[0].start
+
+    # Labels are usually numbered in scan order, then every slice holds one range of them and the range ends give
+    # the slice of every label without going over the voxels again
+    per_slice = labels.reshape(depth, -1)
+    last = per_slice.max(axis=1)
+    first = np.min(per_slice, axis=1, initial=N + 1, where=per_slice != 0)
+    found = np.flatnonzero(last)
+    slice_of = np.zeros(N + 1, dtype=np.intp)
+    if np.all(first[found[1:]] > last[found[:-1]]):
+        slice_of[1:] = np.repeat(found + first_slice, last[found] - first[found] + 1)
+    else:
+        # All voxels of a component are in one slice, so whichever is written last gives it
+        slice_of[labels] = np.arange(depth)[:, None, None] + first_slice
+        slice_of[0] = 0
+
+    labels = labels[:, :height]
+
+    return Components(labels, sizes, slices=bbox, shape=array.shape, slice_of=slice_of)
+
+
+def label_background(array: np.ndarray, connectivity: int = 6, bbox: tuple = None) -> Components:
+    """Labels the connected components of the background (voxels equal to 0) of the mask.
+
+    Only the foreground bounding box with a one voxel margin is labeled. The margin is background, so every
+    component touching it is connected to the rest of the volume outside the box. Those components are merged
+    into one, which includes the voxels outside the box, so the components and their sizes are exactly those of
+    labeling the whole volume.
+
+    Args:
+        array (np.ndarray): mask in array format
+        connectivity (int, optional): Define the connectivity directions. Defaults to 6.
+        bbox (tuple, optional): slices of a box containing all the foreground, e.g. from foreground_bbox.
+            Defaults to None (computed here).
+
+    Returns:
+        Components: label map and voxel number of every background component
+    """
+    if bbox is None:
+        bbox = foreground_bbox(array)
+
+    if bbox is not None:
+        bbox = tuple(slice(max(i.start - 1, 0), min(i.stop + 1, size)) for i, size in zip(bbox, array.shape))
+
+    # The part of the volume outside the box is connected unless the box spans two axes completely
+    if bbox is None or sum(i.start == 0 and i.stop == size for i, size in zip(bbox, array.shape)) >= 2:
+        return label_components(array == 0, connectivity=connectivity)
+
+    components = label_components(array[bbox] == 0, connectivity=connectivity)
+    labels, sizes = components.labels, components.sizes
+
+    # Every margin face is a plane of background, so one voxel of it gives the label of the whole face
+    outside = set()
+    for axis, (i, size) in enumerate(zip(bbox, array.shape)):
+        if i.start > 0:
+            outside.add(int(np.take(labels, 0, axis=axis).flat[0]))
+        if i.stop < size:
+            outside.add(int(np.take(labels, -1, axis=axis).flat[0]))
+    outside = sorted(outside)
+
+    outside_size = array.size - labels.size + int(sizes[outside].sum())
+
+    if len(outside) > 1:
+        # Merges the labels connected through the outside into the first of them
+        merged = np.ones(len(sizes), dtype=bool)
+        merged[outside[1:]] = False
+        lut = np.zeros(len(sizes), dtype=labels.dtype)
+        lut[merged] = np.arange(merged.sum())
+        lut[outside[1:]] = lut[outside[0]]
+
+        labels = lut[labels]
+        sizes = sizes[merged]
+
+    outside_label = outside[0]
+    sizes[outside_label] = outside_size
+
+    return Components(labels, sizes, slices=bbox, shape=array.shape, outside_label=outside_label)
+
+
+def component_values(components: Components, array: np.ndarray) -> np.ndarray:
+    """Finds the value of array every component of a multi-label mask was labeled from.
+
+    Args:
+        components (Components): from label_components on array
+        array (np.ndarray): the labeled mask, full volume
+
+    Returns:
+        np.ndarray: value of every label (length n + 1), 0 for the background
+    """
+    cropped = array if components.slices is None else array[components.slices]
+
+    # All voxels of a component share its value, so whichever voxel is written last gives it
+    values = np.zeros(len(components.sizes), dtype=array.dtype)
+    values[components.labels] = cropped
+    values[0] = 0
+
+    return values
+
+
+def face_contacts(components: Components, array: np.ndarray, n_values: int, of: np.ndarray = None) -> np.ndarray:
+    """Counts the voxel faces every component shares with every value of array.
+
+    Args:
+        components (Components): components labeled within components.slices of array
+        array (np.ndarray): full volume of small nonnegative integers (below n_values), e.g. indices of label values
+        n_values (int): number of values array can take
+        of (np.ndarray, optional): boolean array over all labels, only the faces of these components are counted.
+            Defaults to None (all components).
+
+    Returns:
+        np.ndarray: (n + 1, n_values) counts, faces with voxels of the same component included
+    """
+    labels = components.labels
+    values = array if components.slices is None else array[components.slices]
+
+    contacts = np.zeros(len(components.sizes) * n_values, dtype=np.int64)
+    for axis in range(labels.ndim):
+        lower = [slice(None)] * labels.ndim
+        upper = [slice(None)] * labels.ndim
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+
+        for a, b in ((tuple(lower), tuple(upper)), (tuple(upper), tuple(lower))):
+            if of is None:
+                pairs = labels[a].astype(np.int64) * n_values + values[b]
+            else:
+                counted = of[labels[a]]
+                pairs = labels[a][counted].astype(np.int64) * n_values + values[b][counted]
+            contacts += np.bincount(pairs.ravel(), minlength=len(contacts))
+
+    return contacts.reshape(len(components.sizes), n_values)
@@ -1,6 +1,8 @@
 import regex as re
 import os
 
+MASK_EXTENSIONS = ('.nii.gz', '.nii', '.mhd', '.npy', '.npz')
+
 
 def find_seq_num(scan_name, number_of_digits=4, ignore_miss=False) -> str:
     """ Finds 4 digit id-number of scan in the filename.
@@ -38,9 +40,161 @@ def find_seq_num(scan_name, number_of_digits=4, ignore_miss=False) -> str:
         raise Exception(f'No matches found! for {scan_name}')
 
 
+def find_pt_id(scan_name: str) -> str:
+    """ Finds the patient id in the filename, falling back to 3 and 2 digit ids (zfilled to 4) if there is no 4 digit one.
+
+    Args:
+        scan_name (str): filename to search in
+
+    Returns:
+        str: 4 digit patient id
+    """
+    try:
+        return find_seq_num(scan_name)
+    except:
+        try:
+            return find_seq_num(scan_name, number_of_digits=3).zfill(4)
+        except:
+            return find_seq_num(scan_name, number_of_digits=2).zfill(4)
+
+
+def strip_extension(scan_name: str) -> str:
+    """ Removes the mask extension (one of MASK_EXTENSIONS) from the filename, if it has one."""
+    for extension in MASK_EXTENSIONS:
+        if scan_name.endswith(extension):
+            return scan_name[:-len(extension)]
+
+    return scan_name
+
+
+def with_extension(scan_name: str, extension: str = None) -> str:
+    """ Replaces the mask extension of the filename with extension, e.g. to write a mask in another format.
+    Returns the filename unchanged if extension is None."""
+    return scan_name if extension is None else strip_extension(scan_name) + extension
+
+
+def list_masks(directory: str) -> list:
+    """ Lists the mask files in the directory.
+
+    Args:
+        directory (str): where to look
+
+    Returns:
+        list: sorted filenames ending with one of MASK_EXTENSIONS
+    """
+    return sorted(i for i in os.listdir(directory) if i.endswith(MASK_EXTENSIONS))
+
+
+class PatientIndex:
+    """ Index of the masks in a directory by patient id.
+
+    The directory is listed and every filename is parsed once, lookups are dictionary accesses and follow
+    the same 4/3/2 digit fallback rules as find_scan_name.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.names = list_masks(directory)
+        # Files that are in none of the indexes, they have several different numbers in their name for every
+        # digit count and find_seq_num cannot tell which one is the id
+        self.ambiguous = []
+
+        self._by_digits = {4: {}, 3: {}, 2: {}}
+        for name in self.names:
+            # Every digit count on its own, e.g. pt0012_v01 has a single 4 digit id but two 2 digit numbers
+            indexed = failed = False
+            for digits, by_seq_num in self._by_digits.items():
+                try:
+                    seq_num = find_seq_num(name, number_of_digits=digits, ignore_miss=True)
+                except Exception:
+                    failed = True
+                    continue
+
+                if seq_num is not None:
+                    by_seq_num.setdefault(seq_num, []).append(name)
+                    indexed = True
+
+            if failed and not indexed:
+                self.ambiguous.append(name)
+
+    @property
+    def duplicates(self) -> dict:
+        """Patient ids that are shared by more than one file, with those filenames."""
+        return {pt_id: names for pt_id, names in self._by_digits[4].items() if len(names) > 1}
+
+    def find(self, pt_id: str, step: bool = True) -> str:
+        """ Finds the filename with the given id.
+
+        Args:
+            pt_id (str): pt_id to find
+            step (bool, optional): If it finds 0 matches should it revert to searching for zfill(3) strings. Defaults to True.
+
+        Returns:
+            str: filename with the given id
+        """
+        matching_scan_names = self._by_digits[4].get(pt_id, [])
+
+        if len(matching_scan_names) == 1:
+            return matching_scan_names[0]
+
+        elif step:
+            short_id = str(int(pt_id)).zfill(3)
+            matching_scan_names = self._by_digits[3].get(short_id, [])
+            if len(matching_scan_names) == 1:
+                return matching_scan_names[0]
+            else:
+                matching_scan_names = self._by_digits[2].get(short_id, [])
+            if len(matching_scan_names) == 1:
+                return matching_scan_names[0]
+
+        raise(Exception(
+            f'Error: {len(matching_scan_names)} scans found for patient {pt_id}'))
+
+
+def pair_masks(scan_names: list, *indexes: PatientIndex) -> list:
+    """ Finds the patient id of every scan and its matching file in each of the indexes.
+
+    All patients are checked before anything is returned, so a missing or duplicated mask is reported up front
+    together with every other one, instead of stopping a long run halfway through.
+
+    Args:
+        scan_names (list): filenames to pair
+        indexes (PatientIndex): indexes of the directories to find the matching files in
+
+    Returns:
+        list: list of tuples (scan_name, pt_id, filename in the first index, filename in the second index, ...)
+    """
+    pairs = []
+    errors = []
+    for scan_name in scan_names:
+        try:
+            pt_id = find_pt_id(scan_name)
+        except Exception as e:
+            errors.append(f'{scan_name}: {e}')
+            continue
+
+        try:
+            pairs.append((scan_name, pt_id) + tuple(index.find(pt_id) for index in indexes))
+        except Exception as e:
+            duplicates = [f'{index.directory} has {", ".join(index.duplicates[pt_id])}'
+                          for index in indexes if pt_id in index.duplicates]
+            errors.append(f'{scan_name}: {e}' + ''.join(f'; {i}' for i in duplicates))
+
+    for index in indexes:
+        for name in index.ambiguous:
+            print(f'Warning: {name} in {index.directory} has several numbers in its name and is ignored')
+
+    if errors:
+        raise Exception('Could not pair the masks of all patients:\n' + '\n'.join(errors))
+
+    return pairs
+
+
 def find_scan_name(pt_id: str, directory: str, step: bool = True) -> str:
     """ Searches the directory for a filename with the given id.
 
+    Lists the directory on every call, use PatientIndex to look up many patients in the same directory.
+
     Args:
         pt_id (str): pt_id to find
         directory (str): where to look
@@ -49,30 +203,72 @@ def find_scan_name(pt_id: str, directory: str, step: bool = True) -> str:
     Returns:
         str: filename with the given id
     """
+    return PatientIndex(directory).find(pt_id, step=step)
 
-    list_of_names = [i for i in os.listdir(directory)
-                     if i.endswith(('.nii.gz', '.nii', '.mhd'))]
 
-    matching_scan_names = [
-        i for i in list_of_names if find_seq_num(i, ignore_miss=True) == pt_id]
+def parse_shard(shard: str) -> tuple:
+    """ Parses a shard spec 'i/n' (shard i of n, counted from 0).
 
-    if len(matching_scan_names) == 1:
-        return matching_scan_names[0]
+    Args:
+        shard (str): shard spec, e.g. '0/4'
 
-    elif step:
-        matching_scan_names = [
-            i for i in list_of_names if find_seq_num(i, number_of_digits=3, ignore_miss=True) == str(int(pt_id)).zfill(3)]
-        if len(matching_scan_names) == 1:
-            return matching_scan_names[0]
-        else:
-            matching_scan_names = [
-                i for i in list_of_names if find_seq_num(i, number_of_digits=2, ignore_miss=True) == str(int(pt_id)).zfill(3)]
-        if len(matching_scan_names) == 1:
-            return matching_scan_names[0]
-        else:
-            raise(Exception(
-                f'Error: {len(matching_scan_names)} scans found for patient {pt_id}'))
+    Returns:
+        tuple: (i, n)
+    """
+    try:
+        index, count = (int(i) for i in shard.split('/'))
+    except ValueError:
+        raise Exception(f'Invalid shard {shard}, expected i/n, e.g. 0/4')
 
-    else:
-        raise(Exception(
-            f'Error: {len(matching_scan_names)} scans found for patient {pt_id}'))
+    if count < 1 or not 0 <= index < count:
+        raise Exception(f'Invalid shard {shard}, i must be between 0 and n - 1')
+
+    return index, count
+
+
+def in_shard(pt_id: str, shard: str = None) -> bool:
+    """ Decides if the patient belongs to the shard, by its id only, so every run with the same n splits the
+    patients the same way.
+
+    Args:
+        pt_id (str): patient id, e.g. from find_pt_id
+        shard (str, optional): shard spec 'i/n'. Defaults to None (every patient).
+
+    Returns:
+        bool: if the patient is in the shard
+    """
+    if shard is None:
+        return True
+
+    index, count = parse_shard(shard)
+
+    return int(pt_id) % count == index
+
+
+def shard_masks(scan_names: list, shard: str = None) -> list:
+    """ Keeps the filenames of the patients in the shard. Filenames without a patient id are kept in every shard,
+    so they are reported when they are paired.
+
+    Args:
+        scan_names (list): filenames
+        shard (str, optional): shard spec 'i/n'. Defaults to None (all filenames).
+
+    Returns:
+        list: filenames of the shard
+    """
+    if shard is None:
+        return scan_names
+
+    parse_shard(shard)
+    kept = []
+    for scan_name in scan_names:
+        try:
+            pt_id = find_pt_id(scan_name)
+        except Exception:
+            kept.append(scan_name)
+            continue
+
+        if in_shard(pt_id, shard):
+            kept.append(scan_name)
+
+    return kept
@@ -1,98 +1,239 @@
-import cc3d
 import SimpleITK as sitk
 import numpy as np
-from copy import deepcopy
+from psqc_tools.components import (Components, component_values, face_contacts, foreground_bbox, label_background,
+                                   label_components, label_slices)
+from psqc_tools.profiling import stage, staged
 from psqc_tools.scan_class import Scan
 
 
-def find_sort_components(array: np.ndarray, connectivity: int = 6) -> list:
+def find_sort_components(array: np.ndarray, connectivity: int = 6, k: int = None) -> list:
     """finds all connected components in the array and sorts them by voxel number.
 
+    Materializes a separate array for every component, use label_components where the
+    label map and size table are enough.
+
     Args:
         array (np.ndarray): mask in array format
-        connectivity (int, optional): Define the connectivity directions. Defaults to 26.
+        connectivity (int, optional): Define the connectivity directions. Defaults to 6.
+        k (int, optional): only return the k largest components. Defaults to None (all).
 
     Returns:
         list: list of tuples (voxel_number, array)
     """
-    labels_out, N = cc3d.largest_k(
-        array, k=100,
-        connectivity=connectivity, delta=0,
-        return_N=True,
-    )
-
-    arrays = []
-
-    for i in range(1, N + 1):
-        new_array = np.zeros(array.shape)
-        new_array[labels_out == i] = 1
-        total = np.sum(new_array)
-        arrays.append((total, deepcopy(new_array)))
-
-    arrays.sort(reverse=True, key=lambda x: x[0])
+    components = label_components(array, connectivity=connectivity)
+    order = components.ranked(k)
 
-    return arrays
+    return [(components.sizes[i], (components.labels == i).astype(np.float64)) for i in order]
 
 
-def filter_small_components(base_array: np.ndarray, voxel_threshold: int = 10) -> tuple:
+@staged('filter')
+def filter_small_components(base_array: np.ndarray, voxel_threshold: float = 10, bbox: tuple = None,
+                            connectivity: int = 6, min_voxels: float = 0, slice_wise: bool = False,
+                            components: Components = None) -> tuple:
     """Finds all connected components in the array and filters out those that are smaller than 1/10 of the largest component.
 
     Args:
         base_array (np.ndarray): mask array
-        voxel_threshold(ind, optional): minimum fraction of the largest component (in voxels). Defaults to 10.
+        voxel_threshold(float, optional): components up to 1/voxel_threshold of the largest one (in voxels) are
+            removed. Defaults to 10.
+        bbox (tuple, optional): foreground bounding box (from foreground_bbox), only the box is labeled.
+            Defaults to None (computed here).
+        connectivity (int, optional): connectivity of the components, 6, 18 or 26. Defaults to 6.
+        min_voxels (float, optional): components smaller than this are removed as well, except the largest one.
+            Defaults to 0.
+        slice_wise (bool, optional): to filter the 2D components of every slice relative to the largest one of
+            that slice instead, with the in-plane neighbours of connectivity. Defaults to False.
+        components (Components, optional): components of base_array from label_components, used instead of
+            labeling it again. Defaults to None.
 
     Returns:
         tuple[np.ndarray, bool]: tuple (filtered_array, was_anything_changed)
     """
-    arrays = find_sort_components(base_array)
+    if components is None:
+        if bbox is None:
+            bbox = foreground_bbox(base_array)
+            if bbox is None:
+                return base_array, False
 
-    if len(arrays) > 1:
-        biggest = arrays[0][0]
+        if slice_wise:
+            return _filter_slices(base_array, voxel_threshold, bbox, connectivity, min_voxels)
 
-        combined_array = np.zeros(base_array.shape)
+        components = label_components(base_array, connectivity=connectivity, bbox=bbox)
 
-        for size, array in arrays:
-            if size > biggest / voxel_threshold:
-                combined_array += array
+    if components.n > 1:
+        keep = components.sizes > components.biggest / voxel_threshold
+        if min_voxels:
+            keep &= components.sizes >= min_voxels
+            keep[components.ranked(1)] = True
 
-        return combined_array, True
+        return components.select(keep, dtype=base_array.dtype), True
 
     else:
         return base_array, False
 
 
-def patch_holes(base_array: np.ndarray) -> tuple:
+@staged('patch')
+def patch_holes(base_array: np.ndarray, bbox: tuple = None, voxel_threshold: float = 100,
+                connectivity: int = 6, max_voxels: float = None, slice_wise: bool = False) -> tuple:
     """Patches holes in the connected components.
 
     Args:
         base_array (np.ndarray): mask array
+        bbox (tuple, optional): box containing all the foreground (from foreground_bbox), the background is
+            only labeled within it and a one voxel margin. Defaults to None (computed here).
+        voxel_threshold (float, optional): background components smaller than 1/voxel_threshold of the largest
+            one (the outside) are filled. Defaults to 100.
+        connectivity (int, optional): connectivity of the background components, 6, 18 or 26. Defaults to 6.
+        max_voxels (float, optional): if given, background components smaller than this are filled instead, except
+            the largest one. Defaults to None.
+        slice_wise (bool, optional): to fill the 2D holes of every slice instead, those enclosed in-plane even if
+            they open to a neighbouring slice, relative to the background of that slice outside the mask.
+            Defaults to False.
 
     Returns:
         tuple[np.ndarray, bool]: tuple (patched_array, was_anything_changed)
     """
-    reversed_array = np.zeros(base_array.shape)
-    reversed_array[base_array == 0] = 1
+    if slice_wise:
+        return _patch_slices(base_array, bbox, voxel_threshold, connectivity, max_voxels)
 
-    arrays = find_sort_components(reversed_array)
+    components = label_background(base_array, connectivity=connectivity, bbox=bbox)
 
-    if len(arrays) > 1:
-        biggest = arrays[0][0]
+    if components.n > 1:
+        holes = components.sizes < (components.biggest / voxel_threshold if max_voxels is None else max_voxels)
+        holes[components.ranked(1)] = False
 
-        combined_array = np.zeros(base_array.shape)
+        patched_array = base_array + components.select(holes, dtype=base_array.dtype)
 
-        for size, array in arrays:
-            if size < biggest / 100:
-                combined_array += array
+        return patched_array, True
 
-        patched_array = base_array + combined_array
+    else:
+        return base_array, False
 
-        return patched_array, True
 
+def find_strays(components: Components, whole_mask: np.ndarray, voxel_threshold: float = 10, connectivity: int = 6,
+                min_voxels: float = 0, touching: np.ndarray = None) -> tuple:
+    """Finds the central zone strays, the small components of the central zone mask within the processed whole
+    mask, by their labels in the labeling of the central zone mask.
+
+    Filtering the whole mask only removes whole components, each holding entire central zone components, so the
+    voxels of every label within the whole mask tell which components are left and their sizes, and the strays are
+    picked from this table. Only if a component is split by the whole mask (e.g. zone values other than 1) are
+    its parts within the whole mask labeled again.
+
+    Args:
+        components (Components): components of the central zone mask, from label_components
+        whole_mask (np.ndarray): processed whole mask, full volume
+        voxel_threshold (float, optional): as in filter_small_components, among the components within whole_mask.
+            Defaults to 10.
+        connectivity (int, optional): connectivity of components, 6, 18 or 26. Defaults to 6.
+        min_voxels (float, optional): as in filter_small_components. Defaults to 0.
+        touching (np.ndarray, optional): full volume mask, only strays sharing a voxel face with it are returned
+            (e.g. the peripheral zone), the others separately. components need to cover a one voxel margin around
+            the central zone mask (foreground_bbox with margin=1) to see all faces. Defaults to None (all strays).
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, int]: tuple (strays mask, mask of the strays not touching touching or None if
+            there are none, voxel number of the strays in the strays mask)
+    """
+    cropped = whole_mask if components.slices is None else whole_mask[components.slices]
+    inside = np.bincount(components.labels[cropped], minlength=len(components.sizes))
+    inside[0] = 0
+
+    if np.any((inside != 0) & (inside != components.sizes)):
+        parts = label_components((components.labels != 0) & cropped, connectivity=connectivity)
+        components = Components(parts.labels, parts.sizes, slices=components.slices, shape=components.shape)
+        inside = parts.sizes.copy()
+        inside[0] = 0
+
+    if np.count_nonzero(inside) <= 1:
+        return np.zeros(components.shape, dtype=bool), None, 0
+
+    keep = inside > inside.max() / voxel_threshold
+    if min_voxels:
+        keep &= inside >= min_voxels
+        # The largest one, the first label of the largest size as Components.ranked picks
+        keep[np.argmax(inside)] = True
+    strays = (inside != 0) & ~keep
+
+    apart = None
+    if touching is not None and strays.any():
+        contacts = face_contacts(components, touching.view(np.uint8), 2, of=strays)
+        apart = strays & (contacts[:, 1] == 0)
+        strays &= ~apart
+        apart = components.select(apart) if apart.any() else None
+
+    return components.select(strays), apart, int(inside[strays].sum())
+
+
+def _filter_slices(base_array: np.ndarray, voxel_threshold: float, bbox: tuple, connectivity: int,
+                   min_voxels: float) -> tuple:
+    # filter_small_components on the 2D components of every slice, all labeled at once
+    components = label_slices(base_array, connectivity=connectivity, bbox=bbox)
+    sizes, slice_of = components.sizes, components.slice_of
+
+    biggest = np.zeros(base_array.shape[0], dtype=np.int64)
+    np.maximum.at(biggest, slice_of[1:], sizes[1:])
+    keep = sizes > biggest[slice_of] / voxel_threshold
+    if min_voxels:
+        keep &= sizes >= min_voxels
+    # The largest component of every slice stays
+    keep |= sizes == biggest[slice_of]
+
+    if keep[1:].all():
+        return base_array, False
+
+    return components.select(keep, dtype=base_array.dtype), True
+
+
+def _patch_slices(base_array: np.ndarray, bbox: tuple, voxel_threshold: float, connectivity: int,
+                  max_voxels: float) -> tuple:
+    # patch_holes on the 2D background components of every slice, all labeled at once
+    if bbox is None:
+        bbox = foreground_bbox(base_array)
+        if bbox is None:
+            return base_array, False
+
+    # Only the slices with foreground, with an in-plane margin of one voxel, so the background outside the mask
+    # touches the border of the box in every slice
+    box = (bbox[0],) + tuple(slice(max(i.start - 1, 0), min(i.stop + 1, size))
+                             for i, size in zip(bbox[1:], base_array.shape[1:]))
+    components = label_slices(base_array, connectivity=connectivity, bbox=box, background=True)
+    labels, sizes, slice_of = components.labels, components.sizes, components.slice_of
+
+    outside = np.zeros(len(sizes), dtype=bool)
+    for face in (labels[:, 0], labels[:, -1], labels[:, :, 0], labels[:, :, -1]):
+        outside[face] = True
+    outside[0] = False
+
+    if max_voxels is None:
+        # Background of every slice outside the mask, including the part of the slice outside the box
+        outside_voxels = np.bincount(slice_of, weights=np.where(outside, sizes, 0), minlength=base_array.shape[0])
+        outside_voxels += base_array.shape[1] * base_array.shape[2] - labels.shape[1] * labels.shape[2]
+        holes = sizes < outside_voxels[slice_of] / voxel_threshold
     else:
+        holes = sizes < max_voxels
+    holes &= ~outside
+    holes[0] = False
+
+    if not holes.any():
         return base_array, False
 
+    return base_array + components.select(holes, dtype=base_array.dtype), True
+
+
+def _voxel_limits(scan: Scan, min_component_mm3: float = None, max_hole_mm3: float = None) -> tuple:
+    # (min_voxels, max_voxels) of filter_small_components and patch_holes from volumes in mm³
+    voxel_volume = scan.voxel_volume if min_component_mm3 or max_hole_mm3 is not None else 1
+    min_voxels = min_component_mm3 / voxel_volume if min_component_mm3 else 0
+    max_voxels = max_hole_mm3 / voxel_volume if max_hole_mm3 is not None else None
+
+    return min_voxels, max_voxels
 
-def process_scan(scan: Scan, to_patch_holes: bool = True, to_filter_small_components: bool = True, whole_to_compare: Scan = None) -> Scan:
+
+def process_scan(scan: Scan, to_patch_holes: bool = True, to_filter_small_components: bool = True, whole_to_compare: Scan = None,
+                 filter_threshold: float = 10, hole_threshold: float = 100, connectivity: int = 6,
+                 min_component_mm3: float = None, max_hole_mm3: float = None, slice_wise: bool = False,
+                 components: Components = None) -> Scan:
     """The first filters out the small components and then patches the holes in the mask.
 
     Args:
@@ -100,41 +241,399 @@ def process_scan(scan: Scan, to_patch_holes: bool = True, to_filter_small_compon
         to_patch_holes (bool, optional): to patch small holes in mask or not. Defaults to True.
         to_filter_small_components (bool, optional): to filter out small components or not. Defaults to True.
         whole_to_compare (Scan, optional): corrected whole scan to use for filtering small components.
+        filter_threshold (float, optional): voxel_threshold of filter_small_components. Defaults to 10.
+        hole_threshold (float, optional): voxel_threshold of patch_holes. Defaults to 100.
+        connectivity (int, optional): connectivity of the components and holes, 6, 18 or 26. Defaults to 6.
+        min_component_mm3 (float, optional): components smaller than this volume (mm³) are removed as well, except
+            the largest one. Defaults to None.
+        max_hole_mm3 (float, optional): holes smaller than this volume (mm³) are filled, instead of those smaller
+            than 1/hole_threshold of the background outside the mask. Defaults to None.
+        slice_wise (bool, optional): to filter and patch every slice on its own, with 2D components and holes, for
+            masks with thick slices. Defaults to False.
+        components (Components, optional): components of the mask (scan.array > 0) from label_components, reused
+            by the filter instead of labeling it again. Not used with slice_wise. Defaults to None.
 
     Returns:
-        Scan: processed scan object
+        Scan: processed scan object, with the attributes filtered and patched (bool), removed (voxels filtered out)
+            and filled (voxels of patched holes)
     """
     aug_scan = Scan
     base_array = scan.array
 
-    whole = np.zeros(base_array.shape)
-    whole[scan.array > 0] = 1
+    whole = base_array > 0
+    # Filtering only removes voxels, so the box of the original mask also contains the filtered one
+    bbox = foreground_bbox(whole)
 
     was_changed = False
     was_patched = False
 
+    # Volumes become voxel numbers with the spacing of this mask, sizes are compared without another pass
+    min_voxels, max_hole_voxels = _voxel_limits(scan, min_component_mm3, max_hole_mm3)
+
     if whole_to_compare:
         compare_array = whole_to_compare.array
-        filtered_array = whole.copy()
-        filtered_array[compare_array == 0] = 0
+        filtered_array = whole & (compare_array != 0)
 
         if not np.array_equal(filtered_array, whole):
             was_changed = True
 
     elif to_filter_small_components:
-        filtered_array, was_changed = filter_small_components(whole)
+        filtered_array, was_changed = filter_small_components(whole, filter_threshold, bbox=bbox,
+                                                              connectivity=connectivity, min_voxels=min_voxels,
+                                                              slice_wise=slice_wise,
+                                                              components=None if slice_wise else components)
     else:
         filtered_array = whole
 
+    # Voxels are only counted if something changed
+    removed = np.count_nonzero(whole) - np.count_nonzero(filtered_array) if was_changed else 0
+    filled = 0
+
     if to_patch_holes:
-        filtered_array, was_patched = patch_holes(filtered_array)
+        patched_array, was_patched = patch_holes(filtered_array, bbox=bbox, voxel_threshold=hole_threshold,
+                                                 connectivity=connectivity, max_voxels=max_hole_voxels,
+                                                 slice_wise=slice_wise)
+        if was_patched:
+            filled = np.count_nonzero(patched_array) - np.count_nonzero(filtered_array)
+        filtered_array = patched_array
 
     if was_changed or was_patched:
-        aug_scan = Scan(array=filtered_array, ref=scan.image)
+        aug_scan = Scan(array=filtered_array, ref=scan.ref, pixel_type=scan.pixel_type)
     else:
         aug_scan = scan
 
     aug_scan.filtered = was_changed
     aug_scan.patched = was_patched
+    aug_scan.removed = removed
+    aug_scan.filled = filled
 
     return aug_scan
+
+
+def label_array(array: np.ndarray) -> np.ndarray:
+    """The multi-label mask as an integer array. Float masks holding whole label values (e.g. saved as float64) are
+    cast to int32 and boolean ones to uint8.
+
+    Args:
+        array (np.ndarray): mask array
+
+    Returns:
+        np.ndarray: integer array, None if the mask has fractional (or NaN) values
+    """
+    if np.issubdtype(array.dtype, np.integer):
+        return array
+    if array.dtype == bool:
+        return array.view(np.uint8)
+
+    rounded = np.rint(array)
+    if not np.array_equal(array, rounded):
+        return None
+
+    return rounded.astype(np.int32)
+
+
+def process_labels(scan: Scan, filter_threshold: float = 10, hole_threshold: float = 100, connectivity: int = 6,
+                   min_component_mm3: float = None, max_hole_mm3: float = None) -> tuple:
+    """Quality control of a multi-label mask (e.g. lesions labeled by number or PI-RADS score) that keeps the labels.
+
+    The components of all labels are found in a single labeling pass. Every label keeps the components larger than
+    1/filter_threshold of its own largest component. Holes, background components smaller than 1/hole_threshold
+    of the background outside the mask, are filled with the label they share the most voxel faces with.
+
+    Args:
+        scan (Scan): scan object with integer label values, in an integer or float array (label_array)
+        filter_threshold (float, optional): as in process_scan, relative to the largest component of each label.
+            Defaults to 10.
+        hole_threshold (float, optional): as in process_scan. Defaults to 100.
+        connectivity (int, optional): connectivity of the components and holes, 6, 18 or 26. Defaults to 6.
+        min_component_mm3 (float, optional): as in process_scan, the largest component of every label is kept.
+            Defaults to None.
+        max_hole_mm3 (float, optional): as in process_scan. Defaults to None.
+
+    Returns:
+        tuple[Scan, list]: tuple (processed scan, labels). The scan has the attributes filtered and patched (bool,
+            if any voxels were removed or filled), removed and filled as in process_scan. labels has a dict for
+            every label value of the mask, with the keys label, components, voxels and volume_mm3 (before the QC),
+            voxels_removed, voxels_filled and centroid (z, y, x voxel indices of the kept components).
+    """
+    array = label_array(scan.array)
+    if array is None:
+        raise Exception('Multi-label QC needs whole label values, the mask has fractional ones')
+
+    bbox = foreground_bbox(array)
+    if bbox is None:
+        scan.filtered, scan.patched, scan.removed, scan.filled = False, False, 0, 0
+        return scan, []
+
+    with stage('filter', voxels=array.size):
+        # One labeling pass over all labels, components of different labels are never joined
+        components = label_components(array, connectivity=connectivity, bbox=bbox)
+        values = component_values(components, array)
+        label_values, label_of = np.unique(values[1:], return_inverse=True)
+        n_labels = len(label_values)
+
+        sizes = components.sizes[1:]
+        biggest = np.zeros(n_labels, dtype=np.int64)
+        np.maximum.at(biggest, label_of, sizes)
+        keep = sizes > biggest[label_of] / filter_threshold
+        min_voxels, max_hole_voxels = _voxel_limits(scan, min_component_mm3, max_hole_mm3)
+        if min_voxels:
+            keep &= (sizes >= min_voxels) | (sizes == biggest[label_of])
+
+        voxels = np.bincount(label_of, weights=sizes, minlength=n_labels)
+        removed = np.bincount(label_of, weights=np.where(keep, 0, sizes), minlength=n_labels)
+        counts = np.bincount(label_of, minlength=n_labels)
+
+        if keep.all():
+            filtered_array = array
+        else:
+            filtered_array = components.select(np.concatenate(([0], np.where(keep, values[1:], 0))),
+                                               dtype=array.dtype)
+
+    with stage('patch', voxels=array.size):
+        background = label_background(filtered_array, connectivity=connectivity, bbox=bbox)
+        filled = np.zeros(n_labels)
+
+        holes = background.sizes < (background.biggest / hole_threshold if max_hole_voxels is None
+                                     else max_hole_voxels)
+        # Label 0 is the foreground, the largest component the background outside the mask
+        holes[0] = False
+        holes[background.ranked(1)] = False
+        if background.n > 1 and holes.any():
+            # Every voxel as the index of its label value, 1..n_labels, the background stays 0
+            index = np.zeros(int(label_values.max()) + 1, dtype=np.int64)
+            index[label_values] = np.arange(1, n_labels + 1)
+            contacts = face_contacts(background, index[filtered_array], n_labels + 1, of=holes)
+            fill = contacts[:, 1:].argmax(axis=1)
+
+            patched_array = filtered_array + background.select(np.where(holes, label_values[fill], 0),
+                                                               dtype=array.dtype)
+            filled = np.bincount(fill[holes], weights=background.sizes[holes], minlength=n_labels)
+        else:
+            patched_array = filtered_array
+
+    removed_voxels, filled_voxels = int(removed.sum()), int(filled.sum())
+    if removed_voxels or filled_voxels:
+        aug_scan = Scan(array=patched_array, ref=scan.ref, pixel_type=scan.pixel_type)
+    else:
+        aug_scan = scan
+
+    aug_scan.filtered = removed_voxels > 0
+    aug_scan.patched = filled_voxels > 0
+    aug_scan.removed = removed_voxels
+    aug_scan.filled = filled_voxels
+
+    # Centroid of every label from the table of its components, weighted by their voxel numbers
+    kept_sizes = np.where(keep, sizes, 0)
+    centroids = np.stack([np.bincount(label_of, weights=kept_sizes * axis, minlength=n_labels)
+                          for axis in components.stats()['centroid'][1:].T], axis=1)
+    centroids /= np.bincount(label_of, weights=kept_sizes, minlength=n_labels)[:, None]
+
+    labels = [{'label': int(value), 'components': int(counts[i]), 'voxels': int(voxels[i]),
+               'volume_mm3': float(voxels[i]) * scan.voxel_volume, 'voxels_removed': int(removed[i]),
+               'voxels_filled': int(filled[i]), 'centroid': [round(float(j), 2) for j in centroids[i]]}
+              for i, value in enumerate(label_values)]
+
+    return aug_scan, labels
+
+
+def sweep_thresholds(array: np.ndarray, filter_thresholds: list = (10,), hole_thresholds: list = (100,),
+                     connectivities: list = (6,)) -> list:
+    """Voxels process_scan would remove and fill with every combination of the thresholds and connectivities.
+
+    The mask is labeled once per connectivity, every filter threshold is evaluated at once on the table of
+    component sizes. The background is labeled once per distinct filtered mask (few, as most thresholds keep
+    the same components) and every hole threshold is evaluated on its table of sizes.
+
+    Args:
+        array (np.ndarray): mask array, nonzero voxels are the foreground
+        filter_thresholds (list, optional): filter_threshold values. Defaults to (10,).
+        hole_thresholds (list, optional): hole_threshold values. Defaults to (100,).
+        connectivities (list, optional): connectivity values. Defaults to (6,).
+
+    Returns:
+        list: dicts with the keys connectivity, filter_threshold, hole_threshold, voxels_removed and voxels_filled,
+            one for every combination
+    """
+    mask = _as_mask(array)
+    bbox = foreground_bbox(mask)
+    filter_divisors = np.asarray(filter_thresholds, dtype=np.float64)[:, None]
+    hole_divisors = np.asarray(hole_thresholds, dtype=np.float64)[:, None]
+
+    rows = []
+    for connectivity in connectivities:
+        removed = np.zeros(len(filter_thresholds), dtype=np.int64)
+        filled = np.zeros((len(filter_thresholds), len(hole_thresholds)), dtype=np.int64)
+
+        if bbox is not None:
+            components = label_components(mask, connectivity=connectivity, bbox=bbox)
+            sizes = components.sizes[1:]
+            # keep[i, j]: if component j + 1 survives filter_thresholds[i], as in filter_small_components
+            keep = sizes > components.biggest / filter_divisors
+            if components.n > 1:
+                removed = np.where(keep, 0, sizes).sum(axis=1)
+            else:
+                keep[:] = True
+
+            patterns, inverse = np.unique(keep, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            for p, pattern in enumerate(patterns):
+                filtered = mask if pattern.all() else components.select(np.concatenate(([False], pattern)))
+                background = label_background(filtered, connectivity=connectivity, bbox=bbox)
+                if background.n > 1:
+                    # Label 0 is the foreground, as in patch_holes
+                    holes = background.sizes[1:] < background.biggest / hole_divisors
+                    filled[inverse == p] = np.where(holes, background.sizes[1:], 0).sum(axis=1)
+
+        for i, filter_threshold in enumerate(filter_thresholds):
+            for j, hole_threshold in enumerate(hole_thresholds):
+                rows.append({'connectivity': connectivity, 'filter_threshold': filter_threshold,
+                             'hole_threshold': hole_threshold, 'voxels_removed': int(removed[i]),
+                             'voxels_filled': int(filled[i, j])})
+
+    return rows
+
+
+# Voxel counts of the changes in the changes dict of process_zones
+COUNT_COLUMNS = ['whole_voxels_removed', 'whole_voxels_filled', 'perif_voxels_removed', 'perif_voxels_filled',
+                 'central_voxels_removed', 'central_voxels_filled', 'strays_voxels_converted']
+
+# Bits of the packed label volume of process_zones
+PZ_BIT = 1
+WHOLE_BIT = 2
+
+
+def _as_mask(array: np.ndarray) -> np.ndarray:
+    return array if array.dtype == bool else array > 0
+
+
+def _set_bit(packed: np.ndarray, mask: np.ndarray, bit: int, scratch: np.ndarray) -> None:
+    # packed |= mask * bit, through a reused buffer instead of a new temporary
+    np.multiply(mask.view(np.uint8), bit, out=scratch)
+    packed |= scratch
+
+
+def _has_bits(packed: np.ndarray, bits: int, scratch: np.ndarray) -> np.ndarray:
+    # Voxels with all the bits set
+    np.bitwise_and(packed, bits, out=scratch)
+    return scratch == bits
+
+
+def process_zones(perif_scan: Scan, central_scan: Scan, whole_scan0: Scan = None, filter_threshold: float = 10,
+                  hole_threshold: float = 100, connectivity: int = 6, min_component_mm3: float = None,
+                  max_hole_mm3: float = None, slice_wise: bool = False, strays_touching_pz: bool = False) -> tuple:
+    """Quality control of the zonal masks of one patient. Filters and patches the whole prostate, central and
+    peripheral zone masks, makes the peripheral zone match the processed whole mask, converts central zone strays
+    and fills holes on the border between the zones. The central zone mask is labeled once, for filtering it and
+    for finding its strays (find_strays).
+
+    The peripheral zone and the processed whole mask are kept as bits of a single uint8 volume (PZ_BIT, WHOLE_BIT),
+    so the peripheral zone within the whole mask takes one pass over the volume instead of a chain of full size
+    temporaries.
+
+    Args:
+        perif_scan (Scan): peripheral zone mask
+        central_scan (Scan): central zone mask
+        whole_scan0 (Scan, optional): original whole prostate mask, to check if it matches the zonal masks.
+            Defaults to None (not checked).
+        filter_threshold, hole_threshold, connectivity, min_component_mm3, max_hole_mm3, slice_wise (optional): as
+            in process_scan, for every mask. Central zone strays are always found as 3D components.
+        strays_touching_pz (bool, optional): to only convert the strays that share a voxel face with the peripheral
+            zone, the others are removed from the central zone and the whole mask (counted in whole_voxels_removed).
+            Defaults to False.
+
+    Returns:
+        tuple[Scan, Scan, Scan, dict]: tuple (whole_scan_aug, perif_scan_aug, central_scan_aug, changes), changes has
+            the keys whole_filtered, whole_patched, perif_filtered, perif_patched, central_filtered, central_patched
+            and strays_converted (if any voxels were converted), the voxel counts of these changes (COUNT_COLUMNS) and whole_mismatch if whole_scan0
+            is given
+    """
+    perif_mask = _as_mask(perif_scan.array)
+    central_mask = _as_mask(central_scan.array)
+
+    scratch = np.empty(perif_mask.shape, dtype=np.uint8)
+    packed = perif_mask.astype(np.uint8)
+
+    # Create another 'whole' scan to make all the three masks match up
+    if perif_scan.array.dtype == bool and central_scan.array.dtype == bool:
+        whole_scan_array = perif_mask | central_mask
+    else:
+        whole_scan_array = (central_scan.array == 1) | (perif_scan.array == 1)
+    whole_scan = Scan(array=whole_scan_array, ref=central_scan.ref, pixel_type=central_scan.pixel_type)
+
+    # Processes whole prostate mask
+    thresholds = {'filter_threshold': filter_threshold, 'hole_threshold': hole_threshold, 'connectivity': connectivity,
+                  'min_component_mm3': min_component_mm3, 'max_hole_mm3': max_hole_mm3, 'slice_wise': slice_wise}
+    min_voxels, max_hole_voxels = _voxel_limits(central_scan, min_component_mm3, max_hole_mm3)
+    whole_scan_aug = process_scan(
+        whole_scan, to_patch_holes=True, to_filter_small_components=True, **thresholds)
+    whole_mask = _as_mask(whole_scan_aug.array)
+    _set_bit(packed, whole_mask, WHOLE_BIT, scratch)
+
+    # Processes central zone mask, with a margin around it for the contacts of the strays
+    with stage('filter', voxels=central_mask.size):
+        central_components = label_components(central_mask, connectivity=connectivity,
+                                              bbox=foreground_bbox(central_mask, margin=1))
+    central_scan_aug = process_scan(
+        central_scan, to_patch_holes=True, to_filter_small_components=True, components=central_components,
+        **thresholds)
+
+    # Finds small components in central zone mask that are included in the processed whole prostate mask.
+    # These are considered 'strays' and are believed to be erroneously included in the central zone mask.
+    perif_array_aug = _has_bits(packed, PZ_BIT | WHOLE_BIT, scratch)
+    with stage('strays', voxels=whole_mask.size):
+        strays, apart, strays_voxels = find_strays(
+            central_components, whole_mask, filter_threshold, connectivity=connectivity, min_voxels=min_voxels,
+            touching=perif_array_aug if strays_touching_pz else None)
+
+    if apart is not None:
+        # Strays that do not touch the peripheral zone leave the prostate, as the border holes would put them back
+        # into the central zone otherwise
+        whole_mask = whole_mask & ~apart
+        patched, filled = whole_scan_aug.patched, whole_scan_aug.filled
+        removed = whole_scan_aug.removed + np.count_nonzero(apart)
+        whole_scan_aug = Scan(array=whole_mask, ref=whole_scan.ref, pixel_type=whole_scan.pixel_type)
+        whole_scan_aug.filtered, whole_scan_aug.removed = True, removed
+        whole_scan_aug.patched, whole_scan_aug.filled = patched, filled
+
+    # Processes peripheral zone mask within the processed whole prostate mask, then adds the strays
+    perif_voxels = np.count_nonzero(perif_array_aug)
+    perif_removed = np.count_nonzero(perif_mask) - perif_voxels
+    perif_array_aug, perif_patched = patch_holes(perif_array_aug, bbox=foreground_bbox(perif_mask),
+                                                 voxel_threshold=hole_threshold, connectivity=connectivity,
+                                                 max_voxels=max_hole_voxels, slice_wise=slice_wise)
+    perif_filled = np.count_nonzero(perif_array_aug) - perif_voxels if perif_patched else 0
+    perif_array_aug |= strays
+    perif_scan_aug = Scan(array=perif_array_aug, ref=perif_scan.ref, pixel_type=perif_scan.pixel_type)
+
+    # Now to check for (unlikely) holes in the prostate mask that are on the border between PZ and CZ, they are
+    # in the processed whole mask but in neither zone and are added to the central zone.
+    central_array_aug = _as_mask(central_scan_aug.array)
+    border_holes = np.logical_or(perif_array_aug, central_array_aug, out=strays)
+    np.greater(whole_mask, border_holes, out=border_holes)
+
+    central_patched, central_filled = central_scan_aug.patched, central_scan_aug.filled
+    border_voxels = np.count_nonzero(border_holes)
+    if border_voxels:
+        central_filtered, central_removed = central_scan_aug.filtered, central_scan_aug.removed
+        central_scan_aug = Scan(array=central_array_aug | border_holes, ref=central_scan.ref,
+                                pixel_type=central_scan.pixel_type)
+        central_scan_aug.filtered, central_scan_aug.removed = central_filtered, central_removed
+        central_patched, central_filled = True, central_filled + border_voxels
+    central_scan_aug.patched, central_scan_aug.filled = central_patched, central_filled
+
+    changes = {'whole_filtered': whole_scan_aug.filtered, 'whole_patched': whole_scan_aug.patched,
+               'perif_filtered': perif_removed != 0, 'perif_patched': perif_patched,
+               'central_filtered': central_scan_aug.filtered, 'central_patched': central_patched,
+               'strays_converted': strays_voxels != 0,
+               'whole_voxels_removed': whole_scan_aug.removed, 'whole_voxels_filled': whole_scan_aug.filled,
+               'perif_voxels_removed': perif_removed, 'perif_voxels_filled': perif_filled,
+               'central_voxels_removed': central_scan_aug.removed, 'central_voxels_filled': central_filled,
+               'strays_voxels_converted': strays_voxels}
+
+    if whole_scan0 is not None:
+        # A whole mask of another shape never matches, and is not decoded to find out
+        changes['whole_mismatch'] = (whole_scan0.shape != whole_scan_array.shape
+                                     or not np.array_equal(whole_scan_array, whole_scan0.array))
+
+    return whole_scan_aug, perif_scan_aug, central_scan_aug, changes
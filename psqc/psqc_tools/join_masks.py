@@ -2,43 +2,64 @@ import os
 import SimpleITK as sitk
 from tqdm import tqdm
 import numpy as np
-from psqc_tools.filename_tools import find_seq_num, find_scan_name
+from psqc_tools.filename_tools import PatientIndex, list_masks, pair_masks, with_extension
+from psqc_tools.scan_class import image_from_array, read_image, write_image
 
 """ Works to combine the two separate files for peripheral zone mask and central zone mask in the italian label-set.
     To use if originally had joined masks. Makes pz 1 and tz 2!"""
 
 
-def join_masks(peripheral_dir: str, central_dir: str, out_dir: str) -> None:
+def join_images(perif_mask_img: sitk.Image, central_mask_img: sitk.Image) -> sitk.Image:
+    """ Combines a peripheral and a central zone mask into one mask, pz 1 and cz 2.
+
+    Args:
+        perif_mask_img (sitk.Image): peripheral zone mask
+        central_mask_img (sitk.Image): central zone mask, same size as the peripheral one
+
+    Returns:
+        sitk.Image: UInt8 combined mask with the geometry of the central zone mask
+    """
+    perif_mask_arr = sitk.GetArrayViewFromImage(perif_mask_img)
+    central_mask_array = sitk.GetArrayViewFromImage(central_mask_img)
+
+    combi_array = np.zeros(central_mask_array.shape, dtype=np.uint8)
+    combi_array[perif_mask_arr == 1] = 1
+    combi_array[central_mask_array == 1] = 2
+
+    return image_from_array(combi_array, central_mask_img)
+
+
+def join_masks(peripheral_dir: str, central_dir: str, out_dir: str, pixel_type: int = None, out_extension: str = None,
+               compression_level: int = None) -> None:
+    """ Joins the peripheral and central zone masks of every patient into one mask, pz 1 and cz 2.
+
+    Args:
+        peripheral_dir (str): path to peripheral zone masks
+        central_dir (str): path to central zone masks
+        out_dir (str): where to save the combined masks, under the peripheral zone filenames
+        pixel_type (int, optional): SimpleITK pixel type of the written masks. Defaults to None (same as the central zone mask).
+        out_extension (str, optional): extension (format) of the written masks. Defaults to None (same as the input).
+        compression_level (int, optional): as in mask_io.Backend.write. Defaults to None (default of the format).
+    """
     os.makedirs(out_dir, exist_ok=True)
 
+    patients = pair_masks(list_masks(peripheral_dir), PatientIndex(central_dir))
+
     print('Joining masks...')
-    for mask in tqdm(os.listdir(peripheral_dir)):
-        if mask.endswith(('.mhd', '.nii.gz', '.nii')):
-            try:
-                pt_id = find_seq_num(mask)
-            except:
-                pt_id = find_seq_num(mask, number_of_digits=3).zfill(4)
-
-            perif_mask_path = os.path.join(peripheral_dir, mask)
-            perif_mask_img = sitk.ReadImage(perif_mask_path)
-            perif_mask_arr = sitk.GetArrayFromImage(perif_mask_img)
-
-            central_mask_name = find_scan_name(pt_id, central_dir)
-            central_mask_path = os.path.join(
-                central_dir, central_mask_name)
-            central_mask_img = sitk.ReadImage(central_mask_path)
-            central_mask_array = sitk.GetArrayFromImage(central_mask_img)
-
-            if perif_mask_arr.shape != central_mask_array.shape:
-                raise Exception(
-                    f'Shape of {mask} and {central_mask_name} do not match')
-
-            combi_array = np.zeros(central_mask_array.shape)
-            combi_array[perif_mask_arr == 1] = 1
-            combi_array[central_mask_array == 1] = 2
-
-            combi_mask_img = sitk.GetImageFromArray(combi_array)
-            combi_mask_img.CopyInformation(central_mask_img)
-
-            sitk.WriteImage(combi_mask_img, os.path.join(
-                out_dir, f'{mask}'))
+    for mask, pt_id, central_mask_name in tqdm(patients):
+        perif_mask_path = os.path.join(peripheral_dir, mask)
+        perif_mask_img = read_image(perif_mask_path)
+
+        central_mask_path = os.path.join(
+            central_dir, central_mask_name)
+        central_mask_img = read_image(central_mask_path)
+
+        if perif_mask_img.GetSize() != central_mask_img.GetSize():
+            raise Exception(
+                f'Shape of {mask} and {central_mask_name} do not match')
+
+        combi_mask_img = join_images(perif_mask_img, central_mask_img)
+
+        write_image(combi_mask_img, os.path.join(
+            out_dir, with_extension(mask, out_extension)),
+            central_mask_img.GetPixelID() if pixel_type is None else pixel_type, compression_level)
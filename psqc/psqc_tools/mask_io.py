@@ -0,0 +1,160 @@
+import gzip
+import os
+import shutil
+import tempfile
+import zipfile
+
+import numpy as np
+import SimpleITK as sitk
+
+from psqc_tools.raw_store import RAW_EXTENSION, pixel_type_of, read_raw_array, read_raw_header, sidecar_path, write_raw
+
+""" Reading and writing masks by file format. The format of a path is chosen by its extension, every other
+extension is left to SimpleITK, so a deployment can trade disk space for throughput by the output extension and
+compression_level alone, e.g. .nii instead of .nii.gz, .mhd with raw pixel data, or .npz for training pipelines."""
+
+NPZ_EXTENSION = '.npz'
+
+
+class Backend:
+    """Reads and writes the masks of one file format, through SimpleITK unless a subclass does it itself."""
+
+    extensions = ()
+
+    def read_header(self, path: str) -> dict:
+        """Geometry of the mask without decoding the pixels: shape (in array order, z y x), spacing, origin,
+        direction and pixel_type."""
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(path)
+        reader.ReadImageInformation()
+
+        return {'shape': tuple(reversed(reader.GetSize())), 'spacing': reader.GetSpacing(),
+                'origin': reader.GetOrigin(), 'direction': reader.GetDirection(), 'pixel_type': reader.GetPixelID()}
+
+    def read(self, path: str) -> tuple:
+        """Decodes the mask, returns (image, array), either of them None if the format does not give it."""
+        return sitk.ReadImage(path), None
+
+    def write(self, image: sitk.Image, path: str, compression_level: int = None) -> None:
+        """Writes the image, with the compression of the format if compression_level is None, uncompressed if it
+        is 0, otherwise compressed at that level (1 fastest to 9 smallest) where the format allows it."""
+        if compression_level is not None and path.endswith('.nii.gz'):
+            # SimpleITK compresses NIfTI at a fixed level, the level is applied by writing the .nii and compressing it
+            self._write_gzip(image, path, compression_level)
+            return
+
+        writer = sitk.ImageFileWriter()
+        writer.SetFileName(path)
+        if compression_level:
+            writer.SetUseCompression(True)
+            writer.SetCompressionLevel(compression_level)
+        else:
+            writer.SetUseCompression(False)
+        writer.Execute(image)
+
+    @staticmethod
+    def _write_gzip(image: sitk.Image, path: str, compression_level: int) -> None:
+        handle, uncompressed = tempfile.mkstemp(suffix='.nii', dir=os.path.dirname(path) or None)
+        os.close(handle)
+        try:
+            sitk.WriteImage(image, uncompressed)
+            with open(uncompressed, 'rb') as src, gzip.open(path, 'wb', compresslevel=compression_level) as dst:
+                shutil.copyfileobj(src, dst)
+        finally:
+            os.remove(uncompressed)
+
+    def data_files(self, path: str) -> list:
+        """Files holding the mask, for hashing its content."""
+        # An .mhd header only points to the pixel data
+        if not path.endswith('.mhd'):
+            return [path]
+
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.partition('=')
+                if key.strip() == 'ElementDataFile' and value.strip() != 'LOCAL':
+                    return [path, os.path.join(os.path.dirname(path), value.strip())]
+
+        return [path]
+
+
+class RawBackend(Backend):
+    """The raw store of raw_store, memory-mapped .npy arrays with the geometry in a .json sidecar."""
+
+    extensions = (RAW_EXTENSION,)
+
+    def read_header(self, path: str) -> dict:
+        return read_raw_header(path)
+
+    def read(self, path: str) -> tuple:
+        # The array stays memory-mapped, it is not decompressed or copied
+        return None, read_raw_array(path)
+
+    def write(self, image: sitk.Image, path: str, compression_level: int = None) -> None:
+        # Always uncompressed, the point of the store is to be memory-mapped
+        write_raw(image, path)
+
+    def data_files(self, path: str) -> list:
+        return [path, sidecar_path(path)]
+
+
+class NpzBackend(Backend):
+    """A single .npz file per mask with the array as mask and its geometry as spacing, origin and direction, to be
+    read with numpy alone, e.g. by training pipelines. Compressed unless compression_level is 0."""
+
+    extensions = (NPZ_EXTENSION,)
+
+    def read_header(self, path: str) -> dict:
+        with zipfile.ZipFile(path) as archive:
+            with archive.open('mask.npy') as f:
+                version = np.lib.format.read_magic(f)
+                read_array_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                                     else np.lib.format.read_array_header_2_0)
+                shape, _, dtype = read_array_header(f)
+
+        with np.load(path) as npz:
+            return {'shape': shape, 'spacing': tuple(npz['spacing'].tolist()),
+                    'origin': tuple(npz['origin'].tolist()), 'direction': tuple(npz['direction'].tolist()),
+                    'pixel_type': pixel_type_of(dtype)}
+
+    def read(self, path: str) -> tuple:
+        with np.load(path) as npz:
+            array = npz['mask']
+        # Read-only like the arrays of the other formats
+        array.flags.writeable = False
+
+        return None, array
+
+    def write(self, image: sitk.Image, path: str, compression_level: int = None) -> None:
+        arrays = {'mask': sitk.GetArrayViewFromImage(image), 'spacing': np.array(image.GetSpacing()),
+                  'origin': np.array(image.GetOrigin()), 'direction': np.array(image.GetDirection())}
+
+        compression = zipfile.ZIP_STORED if compression_level == 0 else zipfile.ZIP_DEFLATED
+        with zipfile.ZipFile(path, 'w', compression=compression, compresslevel=compression_level or None) as archive:
+            for name, array in arrays.items():
+                with archive.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.asarray(array), allow_pickle=False)
+
+
+# Backends by extension, anything else goes through SimpleITK
+BACKENDS = {}
+DEFAULT_BACKEND = Backend()
+
+
+def register_backend(backend: Backend) -> None:
+    """Makes backend read and write the paths ending with its extensions."""
+    for extension in backend.extensions:
+        BACKENDS[extension] = backend
+
+
+def backend_of(path: str) -> Backend:
+    """The backend of the path, by its extension."""
+    for extension, backend in BACKENDS.items():
+        if path.endswith(extension):
+            return backend
+
+    return DEFAULT_BACKEND
+
+
+register_backend(RawBackend())
+register_backend(NpzBackend())
@@ -0,0 +1,43 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import SimpleITK as sitk
+from tqdm import tqdm
+
+
+def _init_worker(sitk_threads: int) -> None:
+    # Every process already gets its own patients, SimpleITK threads on top of that only oversubscribe the cores
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(sitk_threads)
+
+
+def imap_patients(func, items: list, workers: int = 1, chunksize: int = None, sitk_threads: int = 1):
+    """Applies func to every item, in a pool of processes if more than one worker is requested, and yields every
+    result as soon as it and the ones before it are done.
+
+    Results come in the order of items, regardless of which worker finished first.
+
+    Args:
+        func (callable): picklable function (module level or functools.partial of one) taking one item
+        items (list): items to process, usually scan names
+        workers (int, optional): number of processes, None uses all cores. Defaults to 1 (no pool).
+        chunksize (int, optional): items sent to a worker at once. Defaults to about 4 chunks per worker.
+        sitk_threads (int, optional): SimpleITK threads in every worker process. Defaults to 1.
+
+    Yields:
+        results of func, in the order of items
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    workers = min(workers, len(items))
+
+    if workers <= 1:
+        for item in tqdm(items):
+            yield func(item)
+        return
+
+    if chunksize is None:
+        chunksize = max(1, len(items) // (workers * 4))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(sitk_threads,)) as executor:
+        yield from tqdm(executor.map(func, items, chunksize=chunksize), total=len(items))
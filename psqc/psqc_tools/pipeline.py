@@ -0,0 +1,170 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import SimpleITK as sitk
+from tqdm import tqdm
+
+from psqc_tools.parallel import imap_patients
+from psqc_tools.profiling import current_log, profiled_process, profiled_read
+from psqc_tools.scan_class import write_image
+
+_DONE = object()
+
+
+def prefetch(func, items: list, depth: int = 2):
+    """Yields func(item) for every item in order, while a background thread already computes the next ones.
+
+    At most depth results wait in the queue, which caps the memory held by results that are not used yet.
+
+    Args:
+        func (callable): function taking one item, usually reading the masks of a patient
+        items (list): items to process
+        depth (int, optional): number of results computed ahead. Defaults to 2.
+
+    Yields:
+        results of func, in the order of items
+    """
+    results = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                results.put((func(item), None))
+        except Exception as e:
+            results.put((None, e))
+        results.put((_DONE, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            result, error = results.get()
+            if error is not None:
+                raise error
+            if result is _DONE:
+                return
+            yield result
+    finally:
+        # Unblocks the producer if the consumer stopped early
+        stop.set()
+        while thread.is_alive():
+            try:
+                results.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
+
+
+class BackgroundWriter:
+    """Writes images in a pool of threads, so compression and disk latency overlap with processing.
+
+    write blocks once max_pending images are waiting, which caps the memory held by unwritten images.
+    Errors of the writes are raised by write or close.
+    """
+
+    def __init__(self, threads: int = 2, max_pending: int = 8):
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._errors = []
+        # Writes queued since the last after_writes, those done without an error are dropped as they finish
+        self._queued = []
+
+    def _write(self, image: sitk.Image, path: str, pixel_type: int, compression_level: int, log) -> bool:
+        try:
+            if log is None:
+                write_image(image, path, pixel_type, compression_level)
+            else:
+                # Records the write in the stage log of the patient that queued it
+                with log.active():
+                    write_image(image, path, pixel_type, compression_level)
+            return True
+        except Exception as e:
+            self._errors.append(e)
+            return False
+        finally:
+            self._slots.release()
+
+    def _after(self, queued: list, func) -> None:
+        # Writes are started in the order they were queued, so the ones waited for already run in other threads
+        if all(future.result() for future in queued):
+            try:
+                func()
+            except Exception as e:
+                self._errors.append(e)
+
+    def _raise_errors(self) -> None:
+        if self._errors:
+            raise self._errors[0]
+
+    def write(self, image: sitk.Image, path: str, pixel_type: int = None, compression_level: int = None) -> None:
+        """Queues the image to be written, arguments as in scan_class.write_image."""
+        self._raise_errors()
+        self._slots.acquire()
+        self._queued = [future for future in self._queued if not (future.done() and future.result())]
+        self._queued.append(self._executor.submit(self._write, image, path, pixel_type, compression_level,
+                                                  current_log()))
+
+    def after_writes(self, func) -> None:
+        """Calls func in the background once every image queued so far is written, not at all if any of these
+        writes failed, e.g. to record that the masks of a patient are complete."""
+        queued, self._queued = self._queued, []
+        self._executor.submit(self._after, queued, func)
+
+    def close(self) -> None:
+        """Waits for all queued images to be written."""
+        self._executor.shutdown(wait=True)
+        self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _read_and_process(item, read, process):
+    return process(read(item))
+
+
+def iter_patients(read, process, items: list, workers: int = 1, chunksize: int = None, read_ahead: int = 0,
+                  io_threads: int = 2, profile: bool = False):
+    """Reads and processes every item, either pipelined in this process or spread over worker processes, and yields
+    every result as soon as it and the ones before it are done.
+
+    With read_ahead set, a background thread reads the next read_ahead patients while the current one is
+    processed, and the processed masks are written by io_threads threads.
+
+    Args:
+        read (callable): picklable function taking one item and returning what process needs
+        process (callable): picklable function taking the result of read and an optional writer keyword
+        items (list): items to process
+        workers (int, optional): as in parallel.imap_patients. Defaults to 1.
+        chunksize (int, optional): as in parallel.imap_patients. Defaults to None.
+        read_ahead (int, optional): patients read ahead, 0 for no pipelining. Defaults to 0.
+        io_threads (int, optional): threads writing the output masks when pipelining. Defaults to 2.
+        profile (bool, optional): to record the time of the stages of every item, see profiling.stage.
+            Defaults to False.
+
+    Yields:
+        results of process, in the order of items, with profile set (result, stage records) tuples
+    """
+    if profile:
+        read = partial(profiled_read, read=read)
+        process = partial(profiled_process, process=process)
+
+    if not read_ahead:
+        yield from imap_patients(partial(_read_and_process, read=read, process=process), items,
+                                 workers=workers, chunksize=chunksize)
+        return
+
+    if workers != 1:
+        raise Exception('Pipelined reading (read_ahead) is only available with workers=1')
+
+    with BackgroundWriter(threads=io_threads, max_pending=2 * io_threads) as writer:
+        for masks in tqdm(prefetch(read, items, depth=read_ahead), total=len(items)):
+            yield process(masks, writer=writer)
@@ -0,0 +1,107 @@
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from psqc_tools.parallel import imap_patients
+from psqc_tools.scan_class import read_header
+
+""" Pre-flight check of the geometry of every mask of a cohort, from the image headers only, so patients whose masks
+cannot be processed together are found before a long run instead of stopping it halfway through."""
+
+# check is 'header' for a mask that is unreadable or not a valid 3D mask, 'match' for one that differs from the
+# first mask of its patient
+REPORT_COLUMNS = ['scan_name', 'mask', 'path', 'check', 'problem']
+
+
+def check_header(header: dict, tolerance: float = 1e-4) -> list:
+    """Checks that the header describes a usable 3D mask.
+
+    Args:
+        header (dict): as returned by scan_class.read_header
+        tolerance (float, optional): allowed deviation of the direction from an orthonormal matrix.
+            Defaults to 1e-4.
+
+    Returns:
+        list: descriptions of the problems found, empty if there are none
+    """
+    problems = []
+    if len(header['shape']) != 3 or min(header['shape']) < 1:
+        problems.append(f'size {tuple(reversed(header["shape"]))} is not that of a 3D mask')
+
+    spacing = np.asarray(header['spacing'], dtype=np.float64)
+    if not np.all(np.isfinite(spacing)) or np.any(spacing <= 0):
+        problems.append(f'spacing {header["spacing"]} is not positive')
+
+    if not np.all(np.isfinite(header['origin'])):
+        problems.append(f'origin {header["origin"]} is not finite')
+
+    direction = np.asarray(header['direction'], dtype=np.float64)
+    dim = int(round(np.sqrt(direction.size)))
+    if dim * dim != direction.size or not np.allclose(direction.reshape(dim, dim) @ direction.reshape(dim, dim).T,
+                                                      np.eye(dim), atol=tolerance):
+        problems.append(f'direction {header["direction"]} is not orthonormal')
+
+    return problems
+
+
+def compare_headers(header: dict, ref: dict, tolerance: float = 1e-4) -> list:
+    """Checks that two masks cover the same voxels, with the same size, spacing, origin and direction.
+
+    Args:
+        header (dict): header of the mask to check, as returned by scan_class.read_header
+        ref (dict): header of the mask it has to match
+        tolerance (float, optional): allowed difference of spacing, origin (mm) and direction. Defaults to 1e-4.
+
+    Returns:
+        list: descriptions of the differences found, empty if there are none
+    """
+    if tuple(header['shape']) != tuple(ref['shape']):
+        return [f'size {tuple(reversed(header["shape"]))} differs from {tuple(reversed(ref["shape"]))}']
+
+    return [f'{key} {header[key]} differs from {ref[key]}' for key in ('spacing', 'origin', 'direction')
+            if not np.allclose(header[key], ref[key], rtol=0, atol=tolerance)]
+
+
+def _check_patient(patient: tuple, tolerance: float) -> list:
+    """Report rows of one patient. Module level so it can run in worker processes."""
+    scan_name, paths = patient
+
+    rows = []
+    headers = {}
+    for mask, path in paths.items():
+        try:
+            headers[mask] = read_header(path)
+        except Exception as e:
+            # SimpleITK puts the reason on the last line of its message
+            reason = str(e).strip().splitlines()[-1]
+            rows.append([scan_name, mask, path, 'header', f'header could not be read: {reason}'])
+            continue
+
+        rows.extend([scan_name, mask, path, 'header', problem] for problem in check_header(headers[mask], tolerance))
+
+    # Every mask has to match the first one of the patient
+    masks = list(headers)
+    for mask in masks[1:]:
+        rows.extend([scan_name, mask, paths[mask], 'match', problem]
+                    for problem in compare_headers(headers[mask], headers[masks[0]], tolerance))
+
+    return rows
+
+
+def preflight_masks(patients: list, workers: int = 1, tolerance: float = 1e-4) -> pd.DataFrame:
+    """Reads the headers of the masks of every patient and checks their geometry, without decoding any pixels.
+
+    Args:
+        patients (list): tuples (scan_name, {mask name: path}), every mask is compared with the first one
+        workers (int, optional): number of processes to spread the patients over, None uses all cores. Defaults to 1.
+        tolerance (float, optional): allowed difference of spacing, origin (mm) and direction. Defaults to 1e-4.
+
+    Returns:
+        pd.DataFrame: one row per problem found, with the scan_name of the patient, the mask name, its path, the
+            check it failed and a description of the problem (REPORT_COLUMNS), empty if every patient passed
+    """
+    check = partial(_check_patient, tolerance=tolerance)
+    rows = [row for patient_rows in imap_patients(check, patients, workers=workers) for row in patient_rows]
+
+    return pd.DataFrame(rows, columns=REPORT_COLUMNS)
@@ -0,0 +1,140 @@
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PROFILE_COLUMNS = ['scan_name', 'stage', 'seconds', 'bytes', 'voxels', 'peak_rss_mb']
+
+_local = threading.local()
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process so far in MB, None where it is not available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class StageLog:
+    """Timings of the stages of one patient.
+
+    Stages only record anything in a thread where the log is active, so with no active log
+    stage() costs a single attribute lookup.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    @contextmanager
+    def active(self):
+        """Makes this the log stage() records to in the current thread."""
+        previous = getattr(_local, 'log', None)
+        _local.log = self
+        try:
+            yield self
+        finally:
+            _local.log = previous
+
+
+def current_log() -> StageLog:
+    """The log active in this thread, None if there is none."""
+    return getattr(_local, 'log', None)
+
+
+@contextmanager
+def stage(name: str, voxels: int = None, paths: list = None):
+    """Records the wall time of the block as stage name in the active log, if there is one.
+
+    Args:
+        name (str): name of the stage
+        voxels (int, optional): voxels handled by the stage. Defaults to None.
+        paths (list, optional): files read or written by the stage, their size is recorded after the block.
+            Defaults to None.
+    """
+    log = current_log()
+    if log is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        size = sum(os.path.getsize(path) for path in paths if os.path.exists(path)) if paths else None
+        log.records.append({'stage': name, 'seconds': seconds, 'bytes': size, 'voxels': voxels,
+                            'peak_rss_mb': peak_rss_mb()})
+
+
+def staged(name: str):
+    """Decorator recording every call of a function taking a mask array first as stage name."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(array, *args, **kwargs):
+            with stage(name, voxels=array.size):
+                return func(array, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def profiled_read(item, read) -> tuple:
+    """Calls read(item) with a new active log, returns (result, log)."""
+    log = StageLog()
+    with log.active():
+        return read(item), log
+
+
+def profiled_process(logged, process, writer=None) -> tuple:
+    """Calls process on the result of profiled_read with its log active, returns (result, records).
+
+    Masks written by a pipeline.BackgroundWriter are recorded in the same log by its threads.
+    """
+    masks, log = logged
+    with log.active(), stage('process'):
+        result = process(masks, writer=writer) if writer is not None else process(masks)
+
+    return result, log.records
+
+
+def profile_table(scan_names: list, records: list) -> pd.DataFrame:
+    """Table of the stage records of every patient, records[i] being the records of scan_names[i]."""
+    rows = [{'scan_name': scan_name, **record} for scan_name, patient in zip(scan_names, records)
+            for record in patient]
+
+    return pd.DataFrame(rows, columns=PROFILE_COLUMNS).astype({'bytes': 'Int64', 'voxels': 'Int64'})
+
+
+def print_profile(df: pd.DataFrame, wall_seconds: float) -> None:
+    """Prints the time, data and peak memory of every stage, over all patients.
+
+    process includes the stages run inside it (filter, patch and, without read_ahead, write).
+    """
+    if df.empty:
+        return
+
+    df = df.astype({'seconds': float, 'bytes': float, 'peak_rss_mb': float})
+    summary = df.groupby('stage', sort=False).agg(patients=('scan_name', 'nunique'), seconds=('seconds', 'sum'),
+                                                  mean_ms=('seconds', 'mean'), mb=('bytes', 'sum'),
+                                                  peak_rss_mb=('peak_rss_mb', 'max'))
+    summary['mean_ms'] *= 1000
+    summary['mb'] /= 2 ** 20
+    summary['share'] = summary['seconds'] / wall_seconds
+
+    print(f'Profile ({wall_seconds:.1f} s wall time):')
+    print(f'{"stage":<10} {"patients":>8} {"total s":>9} {"mean ms":>9} {"of wall":>8} {"MB":>9} {"peak RSS MB":>12}')
+    for name, row in summary.iterrows():
+        print(f'{name:<10} {int(row["patients"]):>8} {row["seconds"]:>9.2f} {row["mean_ms"]:>9.2f} {row["share"]:>8.1%} '
+              f'{row["mb"]:>9.1f} {row["peak_rss_mb"]:>12.1f}')
@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+import SimpleITK as sitk
+
+""" Uncompressed intermediate store. Masks are kept as .npy arrays, opened memory-mapped, with the geometry of
+the image in a .json sidecar, so stages working on the same cohort do not decompress them again."""
+
+RAW_EXTENSION = '.npy'
+
+# Pixel type of the image sitk.GetImageFromArray makes from an array of each dtype
+_PIXEL_TYPES = {np.dtype(np.uint8): sitk.sitkUInt8, np.dtype(np.int8): sitk.sitkInt8,
+                np.dtype(np.uint16): sitk.sitkUInt16, np.dtype(np.int16): sitk.sitkInt16,
+                np.dtype(np.uint32): sitk.sitkUInt32, np.dtype(np.int32): sitk.sitkInt32,
+                np.dtype(np.uint64): sitk.sitkUInt64, np.dtype(np.int64): sitk.sitkInt64,
+                np.dtype(np.float32): sitk.sitkFloat32, np.dtype(np.float64): sitk.sitkFloat64}
+
+
+def sidecar_path(path: str) -> str:
+    """Path of the geometry sidecar of a raw mask."""
+    return path[:-len(RAW_EXTENSION)] + '.json'
+
+
+def write_raw(image: sitk.Image, path: str) -> None:
+    """Writes the image as a raw array at path and its geometry next to it.
+
+    Args:
+        image (sitk.Image): image to store
+        path (str): path ending with .npy
+    """
+    geometry = {'spacing': image.GetSpacing(), 'origin': image.GetOrigin(), 'direction': image.GetDirection()}
+
+    # The sidecar goes first, a raw array is only listed once its geometry exists
+    with open(sidecar_path(path), 'w') as f:
+        json.dump(geometry, f)
+    np.save(path, sitk.GetArrayViewFromImage(image))
+
+
+def read_raw_array(path: str) -> np.ndarray:
+    """Opens a raw mask as a read-only memory-mapped array, without reading it."""
+    return np.load(path, mmap_mode='r')
+
+
+def pixel_type_of(dtype: np.dtype) -> int:
+    """SimpleITK pixel type of a raw array of dtype, bool arrays are stored as UInt8 images."""
+    dtype = np.dtype(np.uint8 if dtype == bool else dtype)
+    return _PIXEL_TYPES[dtype]
+
+
+def read_raw_header(path: str) -> dict:
+    """Reads the geometry of a raw mask from its sidecar and the .npy header, without reading the array.
+
+    Args:
+        path (str): path ending with .npy
+
+    Returns:
+        dict: shape (in array order), spacing, origin, direction and pixel_type, as scan_class.read_header
+    """
+    with open(sidecar_path(path)) as f:
+        geometry = json.load(f)
+
+    array = read_raw_array(path)
+
+    return {'shape': array.shape, 'spacing': tuple(geometry['spacing']), 'origin': tuple(geometry['origin']),
+            'direction': tuple(geometry['direction']), 'pixel_type': pixel_type_of(array.dtype)}
@@ -1,22 +1,195 @@
+import os
+
 import SimpleITK as sitk
 import numpy as np
+from tqdm import tqdm
+
+from psqc_tools.filename_tools import list_masks, strip_extension
+from psqc_tools.mask_io import backend_of
+from psqc_tools.profiling import stage
+from psqc_tools.raw_store import RAW_EXTENSION
+
+
+def image_from_array(array: np.ndarray, ref) -> sitk.Image:
+    """Makes an image from a mask array with the geometry of ref, an image or a header from read_header.
+    Boolean masks become UInt8 images without a copy."""
+    if array.dtype == bool:
+        array = array.view(np.uint8)
+
+    image = sitk.GetImageFromArray(array)
+    if isinstance(ref, dict):
+        image.SetSpacing(ref['spacing'])
+        image.SetOrigin(ref['origin'])
+        image.SetDirection(ref['direction'])
+    else:
+        image.CopyInformation(ref)
+
+    return image
+
+
+class _ImageBuffer:
+    # Exposes the pixel buffer of an image to numpy and keeps the image alive as long as an array uses it
+    def __init__(self, image: sitk.Image):
+        self.image = image
+        self.__array_interface__ = sitk.GetArrayViewFromImage(image).__array_interface__
+
+
+def array_view(image: sitk.Image) -> np.ndarray:
+    """Read-only array of the image without a copy. Unlike sitk.GetArrayViewFromImage, the array stays valid
+    after the image is no longer referenced elsewhere."""
+    return np.asarray(_ImageBuffer(image))
+
+
+def read_header(path: str) -> dict:
+    """Reads the geometry of a mask from its header, without decoding the pixels.
+
+    Args:
+        path (str): path of the mask, in the format of its extension (mask_io)
+
+    Returns:
+        dict: shape (in array order, z y x), spacing, origin, direction and pixel_type
+    """
+    return backend_of(path).read_header(path)
+
+
+def read_image(path: str) -> sitk.Image:
+    """Reads the image, in the format of the extension of path."""
+    backend = backend_of(path)
+    image, array = backend.read(path)
+
+    return image if image is not None else image_from_array(array, backend.read_header(path))
+
+
+def write_image(image: sitk.Image, path: str, pixel_type: int = None, compression_level: int = None) -> None:
+    """Writes the image, cast to pixel_type (e.g. sitk.sitkUInt8) if it is given and differs from the image's own.
+    The format is chosen by the extension of path (mask_io), compression_level as in mask_io.Backend.write."""
+    with stage('write', voxels=image.GetNumberOfPixels(), paths=[path]):
+        if pixel_type is not None and image.GetPixelID() != pixel_type:
+            image = sitk.Cast(image, pixel_type)
+
+        backend_of(path).write(image, path, compression_level)
+
+
+def convert_masks(in_dir: str, out_dir: str, extension: str = RAW_EXTENSION, compression_level: int = None) -> None:
+    """Writes every mask of in_dir to out_dir in another format, e.g. into the raw store (.npy) once before
+    running several stages over a cohort, or from it back to .nii.gz. Filenames only change their extension.
+
+    Args:
+        in_dir (str): path to the masks
+        out_dir (str): where to save them
+        extension (str, optional): extension of the written masks, any format of mask_io. Defaults to '.npy'
+            (raw store).
+        compression_level (int, optional): as in mask_io.Backend.write. Defaults to None (default of the format).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    for scan_name in tqdm(list_masks(in_dir)):
+        image = read_image(os.path.join(in_dir, scan_name))
+        write_image(image, os.path.join(out_dir, strip_extension(scan_name) + extension),
+                    compression_level=compression_level)
 
 
 class Scan:
+    """A mask as an array and its image, both made only when they are first used.
+
+    A Scan read from path only reads the header, so the geometry of the masks of a patient can be checked before
+    any pixels are decoded. The pixels are decoded by load() or the first use of array. A Scan made from an array
+    keeps ref for its geometry and only builds its image when it is first used, e.g. to be written, so masks that
+    are only inspected never become SimpleITK images.
+
+    Arrays of decoded images are read-only views of the image, raw store arrays are read-only memory maps. Masks of
+    formats decoded without SimpleITK (.npy, .npz) only become images when the image is first used. Assigning a new
+    array (e.g. a writable copy) replaces the mask, its image is rebuilt with the same geometry.
+    """
+
+    def __init__(self, path=None, array=None, ref=None, image=None, pixel_type=None):
+        self.path = path
+        self.header = None
+        self._image = None
+        self._array = None
+        self._ref = None
 
-    def __init__(self, path=None, array=None, ref=None, image=None):
         if path:
-            self.image = sitk.ReadImage(path)
+            self.header = read_header(path)
+            pixel_type = pixel_type if pixel_type is not None else self.header['pixel_type']
 
-        elif image:
-            self.image = image
+        elif image is not None:
+            self._image = image
+            pixel_type = pixel_type if pixel_type is not None else image.GetPixelID()
 
         if type(array) == np.ndarray:
-            self.array = array
-            self.image = sitk.GetImageFromArray(self.array)
-            self.image.CopyInformation(ref)
-        else:
-            self.array = sitk.GetArrayFromImage(self.image)
-
-    def write_image(self, path):
-        sitk.WriteImage(self.image, path)
+            self._array = array
+            self._ref = ref
+            # Masks are processed as bool arrays, but written in the pixel type of the mask they came from
+            if pixel_type is None:
+                pixel_type = ref['pixel_type'] if isinstance(ref, dict) else ref.GetPixelID()
+
+        self.pixel_type = pixel_type
+
+    def load(self):
+        """Decodes the pixels of a Scan read from path, if they are not yet. Returns the Scan."""
+        if self.path and self._array is None:
+            with stage('read', paths=[self.path]):
+                self._image, self._array = backend_of(self.path).read(self.path)
+                if self._array is None:
+                    self._array = array_view(self._image)
+
+        return self
+
+    @property
+    def array(self) -> np.ndarray:
+        if self._array is None:
+            if self.path:
+                self.load()
+            else:
+                self._array = array_view(self._image)
+        return self._array
+
+    @array.setter
+    def array(self, array: np.ndarray):
+        # The image is rebuilt from the new array with the geometry of the old one when it is next used
+        if self._ref is None and self.header is None:
+            self._ref = self.image
+        self._array = array
+        self._image = None
+
+    @property
+    def image(self) -> sitk.Image:
+        if self._image is None:
+            if self.path:
+                self.load()
+            if self._image is None:
+                self._image = image_from_array(self.array, self._ref if self._ref is not None else self.header)
+        return self._image
+
+    @image.setter
+    def image(self, image: sitk.Image):
+        self._image = image
+
+    @property
+    def ref(self):
+        """Geometry of the mask, to make other Scans from arrays without building this one's image."""
+        if self._ref is not None:
+            return self._ref
+        return self.header if self.header is not None else self.image
+
+    @property
+    def spacing(self) -> tuple:
+        """Voxel spacing (x, y, z) in mm, without building the image."""
+        ref = self.ref
+        return ref['spacing'] if isinstance(ref, dict) else ref.GetSpacing()
+
+    @property
+    def voxel_volume(self) -> float:
+        """Volume of a voxel in mm³."""
+        return float(np.prod(self.spacing))
+
+    @property
+    def shape(self) -> tuple:
+        """Shape of the array, from the header if the pixels are not decoded yet."""
+        return self.header['shape'] if self._array is None and self.header is not None else self.array.shape
+
+    def write_image(self, path, pixel_type=None, writer=None, compression_level=None):
+        """Writes the image, directly or through a pipeline.BackgroundWriter if writer is given."""
+        write = writer.write if writer is not None else write_image
+        write(self.image, path, pixel_type if pixel_type is not None else self.pixel_type, compression_level)
@@ -2,39 +2,58 @@ import SimpleITK as sitk
 import os
 import numpy as np
 from tqdm import tqdm
+from psqc_tools.filename_tools import list_masks, with_extension
+from psqc_tools.scan_class import image_from_array, read_image, write_image
 
 """ Separates the masks if they were originally joined. This is needed in the for the main function"""
 
 
-def separate_masks(orig: str, OUT: str) -> None:
+def separate_array(array: np.ndarray) -> tuple:
+    """ Splits a combined mask (pz=1, cz=2) into whole, peripheral and central zone masks.
 
-    for file_name in tqdm([i for i in os.listdir(orig) if i.endswith(('.mhd', '.nii.gz', '.nii'))]):
+    Args:
+        array (np.ndarray): combined mask array
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: tuple (whole_array, perif_array, central_array) of boolean masks
+    """
+    return array > 0, array == 1, array == 2
+
+
+def separate_masks(orig: str, OUT: str, pixel_type: int = None, out_extension: str = None,
+                   compression_level: int = None) -> None:
+    """ Writes the whole, peripheral and central zone masks of every combined mask in orig to OUT/whole,
+    OUT/peripheral and OUT/central.
+
+    Args:
+        orig (str): path to combined masks (pz=1, cz=2)
+        OUT (str): where to save the separated masks
+        pixel_type (int, optional): SimpleITK pixel type of the written masks. Defaults to None (same as the input).
+        out_extension (str, optional): extension (format) of the written masks. Defaults to None (same as the input).
+        compression_level (int, optional): as in mask_io.Backend.write. Defaults to None (default of the format).
+    """
+
+    for file_name in tqdm(list_masks(orig)):
         path = os.path.join(orig, file_name)
-        img = sitk.ReadImage(path)
-        array = sitk.GetArrayFromImage(img)
+        img = read_image(path)
+        array = sitk.GetArrayViewFromImage(img)
 
-        whole_array = np.zeros(array.shape)
-        whole_array[array > 0] = 1
-        whole_img = sitk.GetImageFromArray(whole_array)
-        whole_img.CopyInformation(img)
+        whole_array, perif_array, central_array = separate_array(array)
 
-        perif_array = np.zeros(array.shape)
-        perif_array[array == 1] = 1
-        perif_img = sitk.GetImageFromArray(perif_array)
-        perif_img.CopyInformation(img)
+        out_pixel_type = img.GetPixelID() if pixel_type is None else pixel_type
 
-        central_array = np.zeros(array.shape)
-        central_array[array == 2] = 1
-        central_img = sitk.GetImageFromArray(central_array)
-        central_img.CopyInformation(img)
+        whole_img = image_from_array(whole_array, img)
+        perif_img = image_from_array(perif_array, img)
+        central_img = image_from_array(central_array, img)
 
         os.makedirs(os.path.join(OUT, 'whole'), exist_ok=True)
         os.makedirs(os.path.join(OUT, 'peripheral'), exist_ok=True)
         os.makedirs(os.path.join(OUT, 'central'), exist_ok=True)
 
-        sitk.WriteImage(whole_img, os.path.join(
-            OUT, f'whole/{file_name}'))
-        sitk.WriteImage(perif_img, os.path.join(
-            OUT, f'peripheral/{file_name}'))
-        sitk.WriteImage(central_img, os.path.join(
-            OUT, f'central/{file_name}'))
+        out_name = with_extension(file_name, out_extension)
+        write_image(whole_img, os.path.join(
+            OUT, f'whole/{out_name}'), out_pixel_type, compression_level)
+        write_image(perif_img, os.path.join(
+            OUT, f'peripheral/{out_name}'), out_pixel_type, compression_level)
+        write_image(central_img, os.path.join(
+            OUT, f'central/{out_name}'), out_pixel_type, compression_level)
@@ -27,6 +27,7 @@ setup(name='ProstateSeg_QC',
               "pandas",
               "connected-components-3d",
               "regex"],
+      entry_points={'console_scripts': ['psqc=psqc_tools.cli:main']},
       python_requires=">=3.6",
       keywords=['prostate', 'segmentation', 'quality control', 'automated']
       )